@@ -1,38 +1,47 @@
 """
-Handling instantiation of the tests on initialisation. This is necessary
-because the models required need to be registered with Django (for syncdb etc)
+Handling instantiation of the tests. The tests are only instantiated (and
+so their configuration checked, their patterns compiled etc) on first use,
+see get_tests. Their models are registered with Django up front though,
+when the contextual models are loaded, as they are needed for syncdb etc.
 """
+import threading
+import time
+
 from django.core.exceptions import ImproperlyConfigured
 
-from contextual.defaults import TESTS
+from contextual.defaults import TESTS, USE_SNAPSHOTS
 
-def test_setting_to_instance(test_setting):
+def test_setting_to_class(test_setting):
     """
-    Given a tuple triplet test setting, converts
-    to an instance with optional config.
+    Given a tuple triplet test setting, imports
+    and returns the test class it names.
     """
     try:
         import_bits = test_setting[0].rsplit('.', 1)
         module = __import__(import_bits[0], fromlist=[import_bits[1]])
-        klass = getattr(module, import_bits[1])
+        return getattr(module, import_bits[1])
     except ImportError, e:
         raise ImproperlyConfigured("%s: check your CONTEXTUAL_TESTS setting." % e)
+
+def test_setting_to_instance(test_setting):
+    """
+    Given a tuple triplet test setting, converts
+    to an instance with optional config.
+    """
+    klass = test_setting_to_class(test_setting)
     if len(test_setting) < 3:
         instance = klass()
     else:
-        instance = klass(config=test_setting[2]) 
+        instance = klass(config=test_setting[2])
     return instance
 
 def load_tests(tests):
     """
     Instantiates the tests we need to use, passing them
-    an optional config dictionary and returns the test 
+    an optional config dictionary and returns the test
     instances in the order that they need to be processed,
     as it is a case of first match wins.
 
-    By instantiating the classes, we run their __init__s
-    which register the required models with Django.
-
     Arguments: tests - An iterative of tuple triplets.
         e.g ('test.module.path', priority_as_int, config_dict)
     """
@@ -41,10 +50,75 @@ def load_tests(tests):
     # priority order already, so first we sort.
     tests = sorted(tests, key=lambda x: x[1])
     for test in tests:
-        # A quick test to check setting was in 
+        # A quick test to check setting was in
         # correct format, helps the user.
         instance = test_setting_to_instance(test)
         test_instances.append(instance)
     return test_instances
 
-LOADED_TESTS = load_tests(TESTS)
+def test_models(tests):
+    """
+    Returns the models required by the tests without instantiating
+    them, each model once. Only the test classes are imported.
+
+    Arguments: tests - An iterative of tuple triplets as for load_tests.
+    """
+    required = []
+    for test in tests:
+        for model in test_setting_to_class(test).requires_models:
+            if model not in required:
+                required.append(model)
+    return required
+
+def test_model_snapshots(tests):
+    """
+    Returns a dictionary of each model required by the tests to
+    whether any of the tests requiring it use their snapshots.
+
+    Arguments: tests - An iterative of tuple triplets as for load_tests.
+    """
+    snapshots = {}
+    for test in tests:
+        config = len(test) > 2 and test[2] or {}
+        use_snapshot = config.get('use_snapshot', USE_SNAPSHOTS)
+        for model in test_setting_to_class(test).requires_models:
+            snapshots[model] = snapshots.get(model, False) or use_snapshot
+    return snapshots
+
+def register_test_models():
+    """
+    Registers the models required by the tests in the CONTEXTUAL_TESTS
+    setting with Django, for syncdb etc, and watches them for changes,
+    all without instantiating the tests. Called as the models load.
+    """
+    from django.db import models
+    from contextual.generation import watch_model
+    for model in test_models(TESTS):
+        models.register_models('contextual', model)
+        watch_model(model)
+
+_loaded_tests = None
+_load_lock = threading.Lock()
+
+def get_tests():
+    """
+    Returns the instances of the tests in the CONTEXTUAL_TESTS setting,
+    in priority order, loading them first if this is the first call.
+    Called by the middleware on its first request; call it yourself
+    (e.g. from your urls.py) to load them as the process starts.
+    """
+    global _loaded_tests
+    if _loaded_tests is None:
+        _load_lock.acquire()
+        try:
+            if _loaded_tests is None:
+                from contextual.stats import get_stats
+                start = time.time()
+                tests = load_tests(TESTS)
+                stats = get_stats()
+                if stats.enabled:
+                    stats.timing("tests.load.time", time.time() - start)
+                _loaded_tests = tests
+        finally:
+            _load_lock.release()
+    return _loaded_tests
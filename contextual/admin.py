@@ -1,5 +1,7 @@
 from django.contrib import admin
 
+from contextual import test_models
+from contextual.defaults import TESTS
 from contextual.models import ReplacementData, ReplacementTag
 
 class ReplacementDataAdminInline(admin.TabularInline):
@@ -12,3 +14,10 @@ class ReplacementTagAdmin(admin.ModelAdmin):
     search_fields = ['tag', 'default']
 
 admin.site.register(ReplacementTag, ReplacementTagAdmin)
+
+# The rules of each configured test.
+for model in test_models(TESTS):
+    try:
+        admin.site.register(model)
+    except admin.sites.AlreadyRegistered:
+        pass
@@ -0,0 +1,13 @@
+"""
+Context processors for templates replacing their tags while rendering.
+"""
+from contextual.rules import request_variant
+
+
+def contextual(request):
+    """
+    Adds the variant matched for the request, see the contextual template
+    tag. Its replacements (tag to text) are available to templates as
+    {{ contextual_variant.replacements.PHONE }}.
+    """
+    return {'contextual_variant': request_variant(request)}
@@ -4,9 +4,14 @@
 # described in the setting should be loaded.
 # See defaults.py
 
+import re
+
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
+from contextual.generation import watch_model
+
 class BaseTestModel(models.Model):
     """
     The daddy test model, this provides the links
@@ -40,11 +45,28 @@ class HostnameTestModel(BaseTestModel):
 
 class PathTestModel(BaseTestModel):
     """
-    Allows rule matching against specific URL paths (absolute).
+    Allows rule matching against URL paths (absolute); either
+    a specific path, a path prefix or a regular expression.
     """
+    KIND_CHOICES = (
+        ('exact', "Exact path"),
+        ('prefix', "Path prefix"),
+        ('regex', "Regular expression"),
+    )
     path = models.CharField(_("request path"), max_length=255,
-            help_text="Set to exact value of path for positive match.",
+            help_text="The exact path, a prefix (e.g. '/offers/' which matches any path "
+                      "within it) or a regular expression (e.g. '^/lp/[^/]+/$').",
             unique=True)
+    kind = models.CharField(_("kind"), max_length=10, choices=KIND_CHOICES,
+            default='exact', help_text="How the path is matched. An exact match wins, "
+                                       "then a regular expression, then the longest prefix.")
+
+    def clean(self):
+        if self.kind == 'regex':
+            try:
+                re.compile(self.path)
+            except re.error, e:
+                raise ValidationError("Invalid regular expression: %s" % e)
 
 
 class QueryStringTestModel(BaseTestModel):
@@ -68,7 +90,8 @@ class RefererTestModel(BaseTestModel):
     # Yes referrer is spelt wrong, to keep in line
     # with the incorrect spelling of the HTTP header.
     domain = models.CharField(_("referring domain"), max_length=255,
-              help_text="Set to domain of referring site. e.g. 'google.com' or 'google.' to match all.",
+              help_text="Set to domain of referring site. e.g. 'google.com' (also matching its "
+                        "subdomains) or 'google.' to match all.",
               unique=True)
 
     class Meta:
@@ -99,3 +122,9 @@ class BrandedSearchRefererTestModel(BaseTestModel):
         return u"Search referer: %s %s" % (
                 self.search_engine.title(),
                 "Branded" if self.branded else "Unbranded")
+
+
+# Any change to a test rule or its replacements bumps the rules generation.
+for model in (HostnameTestModel, PathTestModel, QueryStringTestModel,
+              RefererTestModel, BrandedSearchRefererTestModel):
+    watch_model(model)
@@ -1,13 +1,23 @@
 import re
-from django.contrib import admin
+import time
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.db import models
+from django.db import connection, models
+from django.db.models import Q
 from django.http import QueryDict
 from urlparse import urlparse
 
-from contextual.defaults import SEARCH_ENGINES
+from contextual.defaults import LOOKUP_CACHE_SIZE, SEARCH_ENGINES, USE_SNAPSHOTS
 from contextual.contextual_models import (HostnameTestModel, PathTestModel, 
         QueryStringTestModel, RefererTestModel, BrandedSearchRefererTestModel)
+from contextual.generation import current_generation, watch_model
+from contextual.lru import LRUCache
+from contextual.stats import get_stats
+from contextual.tries import DomainTrie, PathDispatcher, has_numbered_references
+
+# contextual.rules and contextual.snapshots are only imported where they
+# are used: both import contextual.models, which imports the test classes
+# to register their models (see contextual.register_test_models).
 
 class BaseTest(object):
     """
@@ -19,6 +29,13 @@ class BaseTest(object):
     # for registration.
     requires_models = [] 
     requires_config_keys = {}
+    # The field of each candidate rule passed
+    # to choose along with its pk, if any.
+    query_key = None
+    # The names of the only parts of the request the test reads (see
+    # contextual.fingerprints.FEATURES), if declared; tests reading the
+    # same features of two requests must match the same rule.
+    features = None
 
     def __init__(self, config=None):
         """
@@ -27,16 +44,20 @@ class BaseTest(object):
         required if they would otherwise go uninstalled.
         """
         self.config = config if config else {}
+        self.use_snapshot = self.config.get('use_snapshot', USE_SNAPSHOTS)
+        # The (generation, index) pair last built by get_index.
+        self.snapshot = None
+        self.lookup_cache_size = self.config.get('lookup_cache_size', LOOKUP_CACHE_SIZE)
+        # The (generation, LRUCache, LRUCache) triplet of get_lookup_caches.
+        self.lookup_cache = None
+        # The models of the tests in the CONTEXTUAL_TESTS setting are
+        # registered as the app loads (see contextual.register_test_models)
+        # and with the admin in contextual.admin; this covers any others.
         for model in self.requires_models:
             # Register with Django's model system.
             models.register_models('contextual', model)
-            try:
-                # Register the models with Django's admin system.
-                # Testing raises AlreadyRegistered as I guess the 
-                # class is instantiated twice. Let me know a better way.
-                admin.site.register(model)
-            except admin.sites.AlreadyRegistered:
-                pass
+            # Any change to the model's rules invalidates the snapshot.
+            watch_model(model)
         # Now we test the passed in config dictionary had all
         # the necessary for configuration keys.
         for key, reason in self.requires_config_keys.iteritems():
@@ -48,12 +69,178 @@ class BaseTest(object):
     def test(self, request):
         """
         This is the method that should be called from the
-        outside. It calls a sibling method to work out if
-        we have a rule hit, and if so returns the replacement
-        rules attached to it, else None.
+        outside. It returns the matching rule if we have a
+        hit, else None, recording stats on the way.
+        """
+        stats = get_stats()
+        if not stats.enabled:
+            return self.find_match(request)
+        name = "test.%s" % self.__class__.__name__
+        queries = len(connection.queries)
+        start = time.time()
+        match = self.find_match(request)
+        stats.timing(name + ".time", time.time() - start)
+        stats.incr(name + ".calls")
+        if match:
+            stats.incr(name + ".matches")
+        # Django only keeps track of queries when debugging.
+        if settings.DEBUG:
+            stats.incr(name + ".queries", len(connection.queries) - queries)
+        return match
+
+    def find_match(self, request):
+        """
+        Looks the request up in the in-memory snapshot of this
+        test's rules, or the database if the test doesn't use
+        one, and returns the matching rule, else None.
         """
-        rule = self.lookup_test(request)
-        return rule.replacements.all() if rule else None
+        if not self.use_snapshot:
+            key = self.lookup_key(request)
+            # Both from the same generation of the rules.
+            generation, lookup_cache, matched_rules = self.get_lookup_caches()
+            token = NotImplemented
+            if key is not None:
+                token = lookup_cache.get(key, NotImplemented)
+                if token is None:
+                    # A recent miss, no need to ask the database again.
+                    return None
+                if token is not NotImplemented:
+                    match = matched_rules.get(token)
+                    if match is not None:
+                        return match
+            queryset = self.query(request)
+            if queryset is not NotImplemented:
+                if token is not NotImplemented:
+                    # A recent hit by the resolver, fetched by its pk alone.
+                    match = self.token_match(queryset, token)
+                else:
+                    match = self.query_match(queryset, request)
+                    token = None
+                    if match is not None:
+                        from contextual.rules import rule_token
+                        token = rule_token(match)
+                    if key is not None:
+                        lookup_cache.set(key, token)
+                if match is not None and key is not None:
+                    matched_rules.set(token, match)
+                return match
+        return self.lookup(self.get_index(), request)
+
+    def token_match(self, queryset, token):
+        """
+        Returns the rule of the queryset's model identified by the
+        token (see contextual.rules.rule_token), else None.
+        """
+        if queryset is None:
+            return None
+        pk = token.rsplit(':', 1)[1]
+        try:
+            return queryset.model._default_manager.get(pk=pk)
+        except queryset.model.DoesNotExist:
+            return None
+
+    def query_match(self, queryset, request):
+        """
+        Returns the rule chosen from the candidates in the
+        queryset (as returned by query), else None.
+        """
+        if queryset is None:
+            return None
+        rules = list(queryset)
+        candidates = [(rule.pk, getattr(rule, self.query_key) if self.query_key
+                       else None) for rule in rules]
+        pk = self.choose(candidates, request)
+        if pk is None:
+            return None
+        for rule in rules:
+            if rule.pk == pk:
+                return rule
+        # Chosen from elsewhere (see choose).
+        try:
+            return queryset.model._default_manager.get(pk=pk)
+        except queryset.model.DoesNotExist:
+            return None
+
+    def get_index(self):
+        """
+        Returns the snapshot of this test's rules, rebuilding it
+        first if the rules have changed since it was last built.
+        The snapshot is swapped in whole so concurrent requests
+        always see either the old or the new one.
+        """
+        generation = current_generation()
+        snapshot = self.snapshot
+        if snapshot is None or snapshot[0] != generation:
+            snapshot = (generation, self.build_index())
+            self.snapshot = snapshot
+        return snapshot[1]
+
+    def get_lookup_cache(self):
+        """
+        Returns the LRUCache of lookup_key to the token of the matching
+        rule, or None for no match, of recent database lookups. It is
+        replaced by an empty one whenever the rules change.
+        """
+        return self.get_lookup_caches()[1]
+
+    def get_lookup_caches(self):
+        """
+        Returns the (generation, lookup cache, matched rules) triplet,
+        where matched rules is the LRUCache of token to rule of the rules
+        recently matched by database lookups, so remembered matches
+        needn't be fetched again. Replaced whenever the rules change.
+        """
+        generation = current_generation()
+        lookup_cache = self.lookup_cache
+        if lookup_cache is None or lookup_cache[0] != generation:
+            lookup_cache = (generation, LRUCache(self.lookup_cache_size),
+                            LRUCache(self.lookup_cache_size))
+            self.lookup_cache = lookup_cache
+        return lookup_cache
+
+    def lookup_key(self, request):
+        """
+        Returns a hashable key, made up of everything about the request
+        the test looks at, under which the outcome of the test's database
+        lookup can be remembered, else None. By default None, which
+        means the outcome is never remembered.
+        """
+        return None
+
+    def build_index(self):
+        """
+        Returns the in-memory index of this test's rules which
+        lookup is given. Override along with lookup.
+        """
+        return {}
+
+    def lookup(self, index, request):
+        """
+        Returns the rule within the index that the request
+        matches, else None. Override along with build_index.
+        """
+        return None
+
+    def query(self, request):
+        """
+        Returns a QuerySet of the candidate rules for the request, or None
+        if there can't be any, for use when the test isn't using its
+        snapshot. The candidates of every test are fetched together
+        when possible. Override along with choose; the default of
+        NotImplemented means the test always uses its snapshot.
+        """
+        return NotImplemented
+
+    def choose(self, candidates, request):
+        """
+        Given a list of (pk, query_key value) pairs for the candidates
+        found by query, returns the pk of the rule the request matches,
+        else None. By default the first candidate. Tests with rules the
+        database can't look up may also choose one of those.
+        """
+        if candidates:
+            return candidates[0][0]
+        return None
 
 
 class HostnameTest(BaseTest):
@@ -64,31 +251,57 @@ class HostnameTest(BaseTest):
     """
 
     requires_models = [HostnameTestModel]
+    features = ('host',)
 
-    def test(self, request):
-        hostname = request.get_host()
-        try:
-            match =  HostnameTestModel.objects.get(hostname__iexact=hostname)
-        except HostnameTestModel.DoesNotExist:
-            match =  None
-        return match
+    def build_index(self):
+        from contextual.snapshots import index_rules
+        return index_rules(HostnameTestModel, lambda rule: rule.hostname.lower(),
+                           'hostname')
+
+    def lookup(self, index, request):
+        return index.get(request.get_host().lower())
+
+    def query(self, request):
+        return HostnameTestModel.objects.filter(hostname__iexact=request.get_host())
+
+    def lookup_key(self, request):
+        return request.get_host().lower()
 
 
 class PathTest(BaseTest):
     """
     This test uses the request.path lookup to test
-    for path based matches in the database. Path based
-    test would most usually take highest priority.
+    for path based matches; exact, prefix or regular
+    expression. Path based test would most usually
+    take highest priority.
     """
 
     requires_models = [PathTestModel]
+    features = ('path',)
 
-    def test(self, request):
-        try:
-            match = PathTestModel.objects.get(path__iexact=request.path)
-        except PathTestModel.DoesNotExist:
-            match = None
-        return match
+    def build_index(self):
+        rules = PathTestModel.objects.order_by('pk')
+        if not self.use_snapshot:
+            # Only those the database can't look up for us, and only
+            # their pks, as choose fetches the one it picks.
+            return PathDispatcher(rules.exclude(kind='exact').values_list(
+                                      'kind', 'path', 'pk'))
+        return PathDispatcher([(rule.kind, rule.path, rule) for rule in rules])
+
+    def lookup(self, index, request):
+        return index.lookup(request.path)
+
+    def query(self, request):
+        return PathTestModel.objects.filter(kind='exact', path__iexact=request.path)
+
+    def choose(self, candidates, request):
+        if candidates:
+            return candidates[0][0]
+        # The prefix and regular expression rules are always held in memory.
+        return self.get_index().lookup(request.path)
+
+    def lookup_key(self, request):
+        return request.path.lower()
 
 
 class QueryStringTest(BaseTest):
@@ -104,39 +317,84 @@ class QueryStringTest(BaseTest):
                 'get_key': "Used to select the GET key to do the lookup on.",
             }
 
-    def test(self, request):
-        match = None
+    def __init__(self, config=None):
+        super(QueryStringTest, self).__init__(config=config)
+        self.features = ('GET:%s' % self.config['get_key'],)
+
+    def build_index(self):
+        from contextual.snapshots import index_rules
+        return index_rules(QueryStringTestModel, lambda rule: rule.value.lower(),
+                           'querystring')
+
+    def lookup(self, index, request):
         key = self.config.get('get_key')
         # If that query string key has been set on the request.
         value = request.GET.get(key)
         if value:
-            try:
-                match = QueryStringTestModel.objects.get(value__iexact=value)
-            except QueryStringTestModel.DoesNotExist:
-                pass
-        return match
+            return index.get(value.lower())
+        return None
+
+    def query(self, request):
+        value = request.GET.get(self.config.get('get_key'))
+        if value:
+            return QueryStringTestModel.objects.filter(value__iexact=value)
+        return None
+
+    def lookup_key(self, request):
+        value = request.GET.get(self.config.get('get_key'))
+        if value:
+            return value.lower()
+        return None
 
 
 class RefererTest(BaseTest):
     """
     This is a simple domain referer test, checks the
-    referer URL for a match. Can handle either
-    exact matching or fall back
+    referer URL's hostname for a match. Rules can be
+    a domain, which also matches its subdomains, or a
+    domain without its TLD (e.g 'google.') to match
+    that domain under any TLD. Most specific wins.
     """
 
     requires_models = [RefererTestModel]
+    features = ('referer_host',)
+    query_key = 'domain'
 
-    def test(self, request):
-        match = None
+    def build_index(self):
+        from contextual.snapshots import index_rules
+        return DomainTrie(index_rules(RefererTestModel,
+                                      lambda rule: rule.domain.lower()).iteritems())
+
+    def lookup(self, index, request):
         referer = request.META.get('HTTP_REFERER')
         if referer:
-            parsed_referer = urlparse(referer)
-            try:
-                match = RefererTestModel.objects.get(
-                            domain__iexact=parsed_referer.hostname)
-            except RefererTestModel.DoesNotExist:
-                pass
-        return match
+            hostname = urlparse(referer).hostname
+            if hostname:
+                return index.lookup(hostname)
+        return None
+
+    def query(self, request):
+        referer = request.META.get('HTTP_REFERER')
+        if referer:
+            hostname = urlparse(referer).hostname
+            if hostname:
+                lookups = Q()
+                for pattern in DomainTrie.candidates(hostname):
+                    lookups |= Q(domain__iexact=pattern)
+                return RefererTestModel.objects.filter(lookups)
+        return None
+
+    def choose(self, candidates, request):
+        hostname = urlparse(request.META['HTTP_REFERER']).hostname
+        return DomainTrie([(domain, pk) for pk, domain in candidates]).lookup(hostname)
+
+    def lookup_key(self, request):
+        referer = request.META.get('HTTP_REFERER')
+        if referer:
+            hostname = urlparse(referer).hostname
+            if hostname:
+                return hostname.lower()
+        return None
 
 
 class BrandedSearchRefererTest(BaseTest):
@@ -148,6 +406,7 @@ class BrandedSearchRefererTest(BaseTest):
     """
 
     requires_models = [BrandedSearchRefererTestModel]
+    features = ('referer',)
     requires_config_keys = {
         'brand_terms': "A list of regex strings classed as 'brand terms'.",
     }
@@ -156,58 +415,107 @@ class BrandedSearchRefererTest(BaseTest):
         """
         Override the init so we can precompile the brand term 
         regex's on instantiation and therefore only do that once.
+        The terms are combined into the one pattern, bar any which
+        refer to their groups by number or can't be combined; those
+        are kept apart.
         """
         super(BrandedSearchRefererTest, self).__init__(config=config)
-        self.compiled_brand_terms = []
+        terms = []
+        self.brand_patterns = []
         for term in self.config['brand_terms']:
-            compiled = re.compile(term, re.IGNORECASE|re.UNICODE)
-            self.compiled_brand_terms.append(compiled)
+            if has_numbered_references(term):
+                self.brand_patterns.append(re.compile(term, re.IGNORECASE|re.UNICODE))
+            else:
+                terms.append(u"(?:%s)" % term)
+        self.brand_pattern = None
+        if terms:
+            try:
+                self.brand_pattern = re.compile(u"|".join(terms),
+                                                re.IGNORECASE|re.UNICODE)
+            except re.error:
+                # e.g. two of the terms share a group name; they are
+                # left to be tried one at a time.
+                self.brand_patterns.extend([re.compile(term, re.IGNORECASE|re.UNICODE)
+                                            for term in terms])
+        # The distinct number of labels the search engine
+        # names are made up of, usually just the one.
+        self.engine_sizes = sorted(set([len(engine.split('.'))
+                                        for engine in SEARCH_ENGINES]))
 
-    def test(self, request):
-        match = None
+    def build_index(self):
+        from contextual.snapshots import index_rules
+        return index_rules(BrandedSearchRefererTestModel,
+                           lambda rule: (rule.search_engine, rule.branded))
+
+    def lookup(self, index, request):
+        search = self.get_search(request)
+        if search is not None:
+            return index.get(search)
+        return None
+
+    def query(self, request):
+        search = self.get_search(request)
+        if search is not None:
+            engine, branded = search
+            return BrandedSearchRefererTestModel.objects.filter(
+                    search_engine=engine, branded=branded)
+        return None
+
+    def lookup_key(self, request):
+        return self.get_search(request)
+
+    def get_search(self, request):
+        """
+        Returns a (search engine, branded) pair for requests
+        referred by a search engine, else None.
+        """
         referer = request.META.get('HTTP_REFERER')
         if referer:
             # Parse the referer URL and check we can
             # actually extract a hostname from it.
             url = urlparse(referer)
             if url.hostname:
-                for engine, lookup_key in SEARCH_ENGINES.iteritems():
-                    if engine in url.hostname:
-                        # Now that Google has launched Google Instant with its 
-                        # hashbang, twitter-style, break-the-web, fragment crap we
-                        # have to check whether this exists. If there is no fragment
-                        # we use the normal query string. Thankfully Google just
-                        # uses a normal query string style fragment.
-                        if url.fragment:
-                            query = QueryDict(url.fragment)
-                        else:
-                            query = QueryDict(url.query)
-                        query = query.get(lookup_key)
-                        match = self.get_match(engine, query)
-                        break
-        return match
+                engine = self.get_search_engine(url.hostname)
+                if engine is not None:
+                    # Now that Google has launched Google Instant with its 
+                    # hashbang, twitter-style, break-the-web, fragment crap we
+                    # have to check whether this exists. If there is no fragment
+                    # we use the normal query string. Thankfully Google just
+                    # uses a normal query string style fragment.
+                    if url.fragment:
+                        query = QueryDict(url.fragment)
+                    else:
+                        query = QueryDict(url.query)
+                    query = query.get(SEARCH_ENGINES[engine])
+                    return engine, self.is_branded(query)
+        return None
 
-    def get_match(self, search_engine, query):
+    def get_search_engine(self, hostname):
         """
-        Returns a test match using the search engine
-        and search term used. 
+        Returns the name of the search engine the hostname belongs
+        to, else None. The engine names are matched against the
+        hostname's labels, the leftmost match winning.
         """
-        branded = self.is_branded(query)
-        try:
-            return BrandedSearchRefererTestModel.objects.get(
-                    search_engine=search_engine,
-                    branded=branded)
-        except BrandedSearchRefererTestModel.DoesNotExist:
-            return None
-             
+        labels = hostname.lower().split('.')
+        for start in range(len(labels)):
+            for size in self.engine_sizes:
+                engine = '.'.join(labels[start:start + size])
+                if engine in SEARCH_ENGINES:
+                    return engine
+        return None
+
     def is_branded(self, query):
         """
         Returns True if any of the words within
         the query are branded terms as defined
         by the config dictionary.
         """
-        if query:
-            for term in self.compiled_brand_terms:
-                if term.findall(query):
-                    return True
+        if not query:
+            return False
+        if self.brand_pattern is not None and \
+                self.brand_pattern.search(query) is not None:
+            return True
+        for pattern in self.brand_patterns:
+            if pattern.search(query) is not None:
+                return True
         return False
@@ -0,0 +1,33 @@
+"""
+View decorators altering how the contextual middleware treats a view.
+"""
+try:
+    from functools import wraps
+except ImportError:
+    from django.utils.functional import wraps  # Python 2.4 fallback.
+
+from django.utils.decorators import available_attrs
+
+
+def page_cache_exempt(view_func):
+    """
+    Marks a view's rewritten pages as never to be stored in (or served
+    from) the page cache, e.g. for views rendering per-user content.
+    """
+    def wrapped_view(*args, **kwargs):
+        return view_func(*args, **kwargs)
+    wrapped_view.contextual_page_cache_exempt = True
+    return wraps(view_func, assigned=available_attrs(view_func))(wrapped_view)
+
+
+def replaced_when_rendered(view_func):
+    """
+    Marks a view's responses as having had every tag replaced while
+    rendering (see the contextual template tag) so the middleware
+    needn't scan them. Any tag written out in full is left as is.
+    """
+    def wrapped_view(*args, **kwargs):
+        response = view_func(*args, **kwargs)
+        response.contextual_processed = True
+        return response
+    return wraps(view_func, assigned=available_attrs(view_func))(wrapped_view)
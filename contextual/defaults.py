@@ -26,6 +26,91 @@ DEFAULT_SEARCH_ENGINES = {
     'yahoo': 'p'
 }
 
+# The shared cache key holding the rules generation; a number bumped
+# whenever a tag, replacement or test rule changes so every process
+# knows to rebuild its in-memory rules.
+DEFAULT_GENERATION_KEY = "contextual_generation"
+
+# How long (in seconds) the generation lives in the shared cache.
+# Should it expire, processes simply rebuild once.
+DEFAULT_GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+# How often (in seconds) a process rechecks the shared generation.
+# Changes made within the same process are seen immediately.
+DEFAULT_GENERATION_CHECK_INTERVAL = 1
+
+# Requests whose path starts with any of these prefixes are left alone,
+# on top of those for MEDIA_URL, STATIC_URL and the admin.
+DEFAULT_EXCLUDE_PREFIXES = ()
+
+# Whether the tests look requests up in in-memory snapshots of their rules
+# (the default) or query the database, e.g. for very large rule tables.
+# Can be overridden per test with 'use_snapshot' in its config dictionary.
+DEFAULT_USE_SNAPSHOTS = True
+
+# How many recent lookups (and their outcome, match or not) each test not
+# using its snapshot remembers, saving repeated queries. 0 disables. Can be
+# overridden per test with 'lookup_cache_size' in its config dictionary.
+DEFAULT_LOOKUP_CACHE_SIZE = 1000
+
+# After this many responses in a row without a single tag from the same view,
+# the view's responses are no longer scanned for tags until the rules change.
+# Only for views whose content never holds tags. None disables. Views are told
+# apart by their arguments too, so e.g. each template direct_to_template renders
+# is counted on its own.
+DEFAULT_TAGLESS_VIEW_THRESHOLD = None
+
+# How many views (with their arguments) the counts of tagless responses are
+# kept for, the least recently seen being forgotten.
+DEFAULT_TAGLESS_VIEW_CACHE_SIZE = 1000
+
+# The name of a cookie holding a short key of the variant each visitor gets,
+# with rewritten responses varying on the X-Contextual-Variant request header,
+# so shared caches can keep one copy per variant. None disables.
+DEFAULT_VARIANT_COOKIE = None
+
+# A directory, writable by every process, in which to keep the snapshots of
+# large rule tables (and the replacements of every rule) as memory-mapped
+# files shared by every process on the host. None keeps them per process.
+DEFAULT_SNAPSHOT_DIR = None
+
+# How many recent requests, by fingerprint of the parts of them the tests
+# read, the middleware remembers the matching rule of. 0 disables.
+DEFAULT_DECISION_CACHE_SIZE = 1000
+
+# The dotted path of the stats backend recording how the tests and
+# middleware perform, e.g. 'contextual.stats.MemoryStats'. None disables.
+DEFAULT_STATS_BACKEND = None
+
+# How long (in seconds) rewritten pages are kept in the cache, keyed by their
+# URL, matched rule and the rules generation. None disables the page cache.
+DEFAULT_PAGE_CACHE_TIMEOUT = None
+
+# The prefix of the cache keys the rewritten pages are stored under.
+DEFAULT_PAGE_CACHE_KEY_PREFIX = "contextual_page"
+
 TESTS = getattr(settings, 'CONTEXTUAL_TESTS', DEFAULT_TESTS)
 SESSION_KEY = getattr(settings, 'CONTEXTUAL_SESSION_KEY', DEFAULT_SESSION_KEY)
 SEARCH_ENGINES = getattr(settings, 'CONTEXTUAL_SEARCH_ENGINES', DEFAULT_SEARCH_ENGINES)
+GENERATION_KEY = getattr(settings, 'CONTEXTUAL_GENERATION_KEY', DEFAULT_GENERATION_KEY)
+GENERATION_TIMEOUT = getattr(settings, 'CONTEXTUAL_GENERATION_TIMEOUT',
+                             DEFAULT_GENERATION_TIMEOUT)
+GENERATION_CHECK_INTERVAL = getattr(settings, 'CONTEXTUAL_GENERATION_CHECK_INTERVAL',
+                                    DEFAULT_GENERATION_CHECK_INTERVAL)
+EXCLUDE_PREFIXES = getattr(settings, 'CONTEXTUAL_EXCLUDE_PREFIXES', DEFAULT_EXCLUDE_PREFIXES)
+USE_SNAPSHOTS = getattr(settings, 'CONTEXTUAL_USE_SNAPSHOTS', DEFAULT_USE_SNAPSHOTS)
+STATS_BACKEND = getattr(settings, 'CONTEXTUAL_STATS_BACKEND', DEFAULT_STATS_BACKEND)
+LOOKUP_CACHE_SIZE = getattr(settings, 'CONTEXTUAL_LOOKUP_CACHE_SIZE',
+                            DEFAULT_LOOKUP_CACHE_SIZE)
+PAGE_CACHE_TIMEOUT = getattr(settings, 'CONTEXTUAL_PAGE_CACHE_TIMEOUT',
+                             DEFAULT_PAGE_CACHE_TIMEOUT)
+PAGE_CACHE_KEY_PREFIX = getattr(settings, 'CONTEXTUAL_PAGE_CACHE_KEY_PREFIX',
+                                DEFAULT_PAGE_CACHE_KEY_PREFIX)
+TAGLESS_VIEW_THRESHOLD = getattr(settings, 'CONTEXTUAL_TAGLESS_VIEW_THRESHOLD',
+                                 DEFAULT_TAGLESS_VIEW_THRESHOLD)
+TAGLESS_VIEW_CACHE_SIZE = getattr(settings, 'CONTEXTUAL_TAGLESS_VIEW_CACHE_SIZE',
+                                  DEFAULT_TAGLESS_VIEW_CACHE_SIZE)
+VARIANT_COOKIE = getattr(settings, 'CONTEXTUAL_VARIANT_COOKIE', DEFAULT_VARIANT_COOKIE)
+SNAPSHOT_DIR = getattr(settings, 'CONTEXTUAL_SNAPSHOT_DIR', DEFAULT_SNAPSHOT_DIR)
+DECISION_CACHE_SIZE = getattr(settings, 'CONTEXTUAL_DECISION_CACHE_SIZE',
+                              DEFAULT_DECISION_CACHE_SIZE)
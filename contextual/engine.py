@@ -0,0 +1,168 @@
+"""
+The replacement engine; compiles every available replacement tag
+into a single matcher so that a response body can have all of its
+tags replaced in one scan rather than one scan per tag.
+"""
+import codecs
+import re
+
+# Encodings in which the bytes of the tag brackets and of ASCII
+# characters can never be part of another character, so tags can
+# be matched within encoded content without decoding it first.
+BYTE_SAFE_ENCODINGS = ('utf-8', 'ascii')
+BYTE_SAFE_ENCODING_PREFIXES = ('iso8859-', 'cp125', 'koi8-')
+
+
+def is_byte_safe(charset):
+    """
+    Returns True if content encoded in the given charset
+    can be rewritten without being decoded first.
+    """
+    try:
+        name = codecs.lookup(charset).name
+    except LookupError:
+        return False
+    return name in BYTE_SAFE_ENCODINGS or \
+           name.startswith(BYTE_SAFE_ENCODING_PREFIXES)
+
+
+class ReplacementEngine(object):
+    """
+    Holds one compiled pattern covering every tag it was built
+    with. Build once per set of tags and reuse it for every
+    response; the pattern is the expensive part.
+    """
+
+    def __init__(self, tags, charset=None):
+        """
+        Arguments: tags - An iterable of ReplacementTags (or tag names).
+                   charset - If given, the engine works on content
+                        encoded in this charset rather than on text.
+        """
+        self.tags = tuple([getattr(tag, 'tag', tag) for tag in tags])
+        self.charset = charset
+        # Engines for encoded content, built by encoded() per charset.
+        self.encoded_engines = {}
+        if self.tags:
+            # Longest first so that no tag can shadow a longer one
+            # which shares its prefix within the alternation.
+            alternation = u"|".join([re.escape(tag) for tag in
+                                     sorted(self.tags, key=len, reverse=True)])
+            pattern = ur"\[(%s)\]" % alternation
+            if charset:
+                self.pattern = re.compile(pattern.encode(charset))
+            else:
+                self.pattern = re.compile(pattern, re.UNICODE)
+            # The longest any one match can be, brackets included.
+            self.max_length = max([len(self.encode(tag)) for tag in self.tags]) + 2
+        else:
+            self.pattern = None
+            self.max_length = 0
+        self.bracket = self.encode(u"[")
+
+    def encode(self, text):
+        """
+        Returns the text as this engine's content would hold it.
+        Characters the charset can't represent become HTML
+        character references.
+        """
+        if self.charset:
+            return text.encode(self.charset, 'xmlcharrefreplace')
+        return text
+
+    def encoded(self, charset):
+        """
+        Returns the engine for content encoded in the given charset,
+        which must be byte safe (see is_byte_safe). Its replacement
+        dictionaries must be encoded too (see encode_replacements).
+        """
+        engine = self.encoded_engines.get(charset)
+        if engine is None:
+            engine = ReplacementEngine(self.tags, charset)
+            self.encoded_engines[charset] = engine
+        return engine
+
+    def encode_replacements(self, replacements):
+        """
+        Returns a copy of the replacements dictionary
+        with its tags and values encoded for this engine.
+        """
+        return dict([(self.encode(tag), self.encode(text))
+                     for tag, text in replacements.iteritems()])
+
+    def contains_tags(self, content):
+        """
+        Returns True if the content holds any of the tags. Content
+        without so much as a bracket costs a single find.
+        """
+        if self.pattern is None or content.find(self.bracket) == -1:
+            return False
+        return self.pattern.search(content) is not None
+
+    def rewrite(self, content, replacements):
+        """
+        Replaces every tag found within content with its value from
+        the replacements dictionary (keyed by tag name) in a single
+        pass. Tags missing from the dictionary are left untouched.
+        """
+        if self.pattern is None:
+            return content
+        parts, position = self.replace(content, replacements, len(content))
+        if not parts:
+            # Nothing matched so save on the copy.
+            return content
+        parts.append(content[position:])
+        return content[:0].join(parts)
+
+    def replace(self, content, replacements, limit):
+        """
+        Returns a list of the slices of content interleaved with
+        the replacements for every match starting before limit,
+        along with the position the last match ended at.
+        """
+        parts = []
+        position = 0
+        for match in self.pattern.finditer(content):
+            if match.start() >= limit:
+                break
+            parts.append(content[position:match.start()])
+            parts.append(replacements.get(match.group(1), match.group(0)))
+            position = match.end()
+        return parts, position
+
+    def rewrite_stream(self, chunks, replacements):
+        """
+        Generator which rewrites an iterable of content chunks as they
+        come. Only the last few characters of each chunk, which could be
+        the start of a tag split over two chunks, are held back and
+        carried over so memory use does not grow with the content.
+        """
+        try:
+            if self.pattern is None:
+                for chunk in chunks:
+                    yield chunk
+                return
+            # A match starting before this many characters from
+            # the end of the buffer is bound to be complete.
+            keep = self.max_length - 1
+            pending = None
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                buf = chunk if pending is None else pending + chunk
+                limit = len(buf) - keep
+                parts, position = self.replace(buf, replacements, limit)
+                # Only hold back from the first bracket in the tail, if any.
+                cut = buf.find(self.bracket, max(position, limit))
+                if cut == -1:
+                    cut = len(buf)
+                parts.append(buf[position:cut])
+                pending = buf[cut:]
+                output = buf[:0].join(parts)
+                if output:
+                    yield output
+            if pending:
+                yield self.rewrite(pending, replacements)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
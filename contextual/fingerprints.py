@@ -0,0 +1,62 @@
+"""
+Request fingerprints: a digest of just those parts of a request which the
+loaded tests read (as declared by their features attribute). Requests with
+the same fingerprint are bound to match the same rule, so the middleware
+can remember the outcome rather than running the tests again.
+"""
+from urlparse import urlparse
+
+from django.utils.hashcompat import md5_constructor
+
+
+def referer_host(request):
+    referer = request.META.get('HTTP_REFERER')
+    if referer:
+        return urlparse(referer).hostname
+    return None
+
+# The request features tests may declare they read, by name, each a
+# function returning the feature of the given request. Features named
+# 'GET:key' are the value of that key of the query string.
+FEATURES = {
+    'host': lambda request: request.get_host().lower(),
+    'path': lambda request: request.path.lower(),
+    'referer': lambda request: request.META.get('HTTP_REFERER'),
+    'referer_host': referer_host,
+}
+
+
+def get_feature(request, name):
+    """
+    Returns the named feature of the request.
+    """
+    if name.startswith('GET:'):
+        return request.GET.get(name[4:])
+    return FEATURES[name](request)
+
+
+def get_features(tests):
+    """
+    Returns the sorted names of the features read by any of
+    the tests, else None if any test doesn't declare them.
+    """
+    names = set()
+    for test in tests:
+        if test.features is None:
+            return None
+        names.update(test.features)
+    return sorted(names)
+
+
+def request_fingerprint(request, features):
+    """
+    Returns the fingerprint of the request given
+    the names of the features (see get_features).
+    """
+    parts = []
+    for name in features:
+        value = get_feature(request, name)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        parts.append("%s=%r" % (name, value))
+    return md5_constructor("\n".join(parts)).digest()
@@ -0,0 +1,144 @@
+"""
+Tracks the rules generation; a number which changes whenever a replacement
+tag, a piece of replacement data or a test rule changes. Anything built
+from those tables records the generation it was built at and rebuilds
+itself once the current generation moves on.
+
+The generation lives in the shared cache so that a change saved by one
+process (e.g. through the admin) is picked up by every other process
+without any of them having to poll the database.
+
+The signals a change sends fire before its transaction commits (e.g. within
+the admin's commit_on_success) and any process rebuilding in between would
+build from the old rows under the new generation. So the generation moves on
+again once the change is committed, see bump_pending.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db.models import signals
+
+from contextual.defaults import (GENERATION_KEY, GENERATION_TIMEOUT,
+        GENERATION_CHECK_INTERVAL)
+
+# The last generation this process saw and when it saw it.
+_last_seen = (None, 0)
+# Used in place of the shared generation should the cache not
+# hold on to anything (e.g the dummy backend).
+_local_generation = [0]
+# How many suspend_invalidation calls are outstanding and
+# whether a bump was held back during them.
+_suspended = [0, False]
+# Whether this thread has changed the rules since it last called
+# bump_pending, as the pending attribute.
+_pending = threading.local()
+
+
+def _initial_generation():
+    """
+    Returns a starting generation for when the shared one is missing. It is
+    time based so it will never equal one a process built against before.
+    """
+    return int(time.time() * 1000)
+
+
+def current_generation():
+    """
+    Returns the current rules generation, only asking the shared
+    cache for it once every GENERATION_CHECK_INTERVAL seconds.
+    """
+    global _last_seen
+    generation, checked = _last_seen
+    now = time.time()
+    if generation is None or now - checked >= GENERATION_CHECK_INTERVAL:
+        generation = cache.get(GENERATION_KEY)
+        if generation is None:
+            # Only one process gets to add it, everyone else reads theirs.
+            cache.add(GENERATION_KEY, _initial_generation(), GENERATION_TIMEOUT)
+            generation = cache.get(GENERATION_KEY)
+            if generation is None:
+                generation = _local_generation[0]
+        _last_seen = (generation, now)
+    return generation
+
+
+def bump_generation(**kwargs):
+    """
+    Moves the rules generation on, invalidating anything built
+    from the previous one in every process. Doubles as the
+    signal receiver.
+    """
+    if 'signal' in kwargs:
+        # The change may not be committed yet.
+        _pending.pending = True
+    if _suspended[0]:
+        _suspended[1] = True
+        return
+    _bump()
+
+
+def bump_pending(**kwargs):
+    """
+    Moves the rules generation on again if this thread has changed the
+    rules since it last called this; call it once the changes are
+    committed. Connected to request_finished, by when the transactions
+    of the admin (and of TransactionMiddleware) have been committed.
+    """
+    if getattr(_pending, 'pending', False):
+        _pending.pending = False
+        _bump()
+
+
+def _bump():
+    global _last_seen
+    _local_generation[0] += 1
+    try:
+        generation = cache.incr(GENERATION_KEY)
+    except ValueError:
+        # Not in the cache (never set or expired) so start afresh.
+        generation = _initial_generation()
+        cache.set(GENERATION_KEY, generation, GENERATION_TIMEOUT)
+        if cache.get(GENERATION_KEY) is None:
+            generation = _local_generation[0]
+    _last_seen = (generation, time.time())
+
+
+def suspend_invalidation():
+    """
+    Holds back any bump of the generation until the matching call to
+    resume_invalidation, for bulk changes (e.g. imports) which would
+    otherwise bump it once per row. Only affects this process.
+    """
+    _suspended[0] += 1
+
+
+def resume_invalidation():
+    """
+    Ends a suspend_invalidation, bumping the generation
+    once if any bump was held back in the meantime.
+    """
+    _suspended[0] -= 1
+    if not _suspended[0] and _suspended[1]:
+        _suspended[1] = False
+        bump_generation()
+
+
+request_finished.connect(bump_pending, dispatch_uid="contextual.bump_pending")
+
+
+def watch_model(model):
+    """
+    Connects the signals which bump the generation whenever
+    an instance of the given model (or, for test models, its
+    replacement links) is saved, deleted or changed.
+    """
+    uid = "contextual.%s.%s" % (model._meta.app_label, model._meta.object_name)
+    signals.post_save.connect(bump_generation, sender=model,
+                              dispatch_uid=uid + ".post_save")
+    signals.post_delete.connect(bump_generation, sender=model,
+                                dispatch_uid=uid + ".post_delete")
+    for field in model._meta.many_to_many:
+        signals.m2m_changed.connect(bump_generation, sender=field.rel.through,
+                                    dispatch_uid="%s.%s.m2m_changed" % (uid, field.name))
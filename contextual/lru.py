@@ -0,0 +1,86 @@
+"""
+A small, thread safe, least recently used cache of a bounded size.
+"""
+import threading
+
+
+class LRUCache(object):
+    """
+    Maps keys to values like a dictionary, but only holds on to the
+    size most recently used keys; the least recently used key is
+    dropped whenever a new one would take it over the size.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            # Each key maps to a [previous, next, key, value] link of a
+            # circular list running from the least to the most recently
+            # used key, with root as the sentinel at either end.
+            self.links = {}
+            self.root = root = []
+            root[:] = [root, root, None, None]
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def get(self, key, default=None):
+        """
+        Returns the value of the key, else default,
+        marking the key as the most recently used.
+        """
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                return default
+            self.unlink(link)
+            self.append(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        """
+        Sets the value of the key, marking it as the most recently
+        used and dropping the least recently used if need be.
+        """
+        if self.size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is not None:
+                self.unlink(link)
+                link[3] = value
+            else:
+                if len(self.links) >= self.size:
+                    oldest = self.root[1]
+                    self.unlink(oldest)
+                    del self.links[oldest[2]]
+                link = [None, None, key, value]
+                self.links[key] = link
+            self.append(link)
+        finally:
+            self.lock.release()
+
+    def unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+
+    def append(self, link):
+        last = self.root[0]
+        link[0], link[1] = last, self.root
+        last[1] = link
+        self.root[0] = link
@@ -0,0 +1,36 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from contextual.management.commands.importrules import get_format, get_test_model
+from contextual.rulefiles import export_rules, write_rules
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help="The file's format: csv or jsonl. Defaults to that of its extension, "
+                 "else csv."),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help="How many rules to fetch at a time."),
+    )
+    help = ("Writes the rules of a contextual test model, and their replacements, "
+            "to a CSV or JSON lines file (see importrules).")
+    args = "<test model> [file, defaults to stdout]"
+
+    def handle(self, label=None, path='-', **options):
+        if label is None:
+            raise CommandError("Give the name of the test model to export.")
+        model = get_test_model(label)
+        format = get_format(options, path)
+        if path == '-':
+            stream = sys.stdout
+        else:
+            stream = open(path, 'wb')
+        try:
+            write_rules(stream, format, model,
+                        export_rules(model, options.get('batch_size') or 500))
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
@@ -0,0 +1,66 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from contextual.rulefiles import FORMATS, RuleImporter, read_rules
+
+
+def get_test_model(label):
+    """
+    Returns the contextual test model with the given name,
+    e.g. 'querystringtestmodel', raising CommandError if none.
+    """
+    model = get_model('contextual', label)
+    if model is None or 'replacements' not in \
+            [field.name for field in model._meta.many_to_many]:
+        raise CommandError("Unknown contextual test model: %s" % label)
+    return model
+
+
+def get_format(options, path):
+    """
+    Returns the format given, else the one the file's extension implies.
+    """
+    format = options.get('format')
+    if format is None:
+        format = path.endswith('.jsonl') and 'jsonl' or 'csv'
+    if format not in FORMATS:
+        raise CommandError("Unknown format: %s (choose from %s)" %
+                           (format, ", ".join(FORMATS)))
+    return format
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help="The file's format: csv or jsonl. Defaults to that of its extension, "
+                 "else csv."),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help="How many rules to save per transaction."),
+    )
+    help = ("Creates or updates the rules of a contextual test model, and their "
+            "replacements, from a CSV or JSON lines file (see exportrules).")
+    args = "<test model> [file, defaults to stdin]"
+
+    def handle(self, label=None, path='-', **options):
+        if label is None:
+            raise CommandError("Give the name of the test model to import into.")
+        model = get_test_model(label)
+        format = get_format(options, path)
+        if path == '-':
+            stream = sys.stdin
+        else:
+            stream = open(path, 'rb')
+        importer = RuleImporter(model, options.get('batch_size') or 500)
+        try:
+            try:
+                importer.run(read_rules(stream, format))
+            except ValueError, e:
+                raise CommandError(str(e))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        if int(options.get('verbosity', 1)) > 0:
+            print "%d rules created, %d updated." % (importer.created, importer.updated)
@@ -0,0 +1,194 @@
+"""
+Read-only tables of rules held in memory-mapped files, so that every
+process on a host shares one copy of them rather than each holding its
+own. A table is written once per rules generation, by whichever process
+needs it first, and looked up in place by binary search.
+
+Enabled by setting CONTEXTUAL_SNAPSHOT_DIR to a directory every process
+can write to (e.g. on a tmpfs such as /dev/shm).
+
+The file format is the magic string, the number of records, a table of
+the offset of each record and then the records themselves, sorted by key;
+each record being the length of its key, the key, the length of its value
+and the value. Keys and values are byte strings.
+"""
+import glob
+import mmap
+import os
+import struct
+import tempfile
+
+from django.utils import simplejson
+
+from contextual.defaults import SNAPSHOT_DIR
+
+MAGIC = "CTXS1"
+HEADER = struct.Struct(">5sI")
+OFFSET = struct.Struct(">I")
+KEY_LENGTH = struct.Struct(">H")
+VALUE_LENGTH = struct.Struct(">I")
+
+
+def is_enabled():
+    """
+    Returns True if rule tables should be held in memory-mapped files.
+    """
+    return bool(SNAPSHOT_DIR)
+
+
+def write_table(path, items):
+    """
+    Writes the (key, value) pairs to a table at the given path. Of any
+    pairs sharing a key the first wins. The table is written to a
+    temporary file first and then renamed into place, so it is
+    never seen half written.
+    """
+    records = []
+    seen = set()
+    # Sorting is stable so the first of any duplicates stays first.
+    for key, value in sorted(items, key=lambda item: item[0]):
+        if key not in seen:
+            seen.add(key)
+            records.append(KEY_LENGTH.pack(len(key)) + key +
+                           VALUE_LENGTH.pack(len(value)) + value)
+    offsets = []
+    offset = HEADER.size + OFFSET.size * len(records)
+    for record in records:
+        offsets.append(OFFSET.pack(offset))
+        offset += len(record)
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        output = os.fdopen(handle, 'wb')
+        try:
+            output.write(HEADER.pack(MAGIC, len(records)))
+            output.write("".join(offsets))
+            output.write("".join(records))
+        finally:
+            output.close()
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class MappedTable(object):
+    """
+    A table written by write_table, mapped into memory.
+    """
+
+    def __init__(self, path):
+        table = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(table.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            table.close()
+        magic, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a rules table." % path)
+
+    def __len__(self):
+        return self.count
+
+    def key_at(self, index):
+        """
+        Returns the key and the offset of the
+        value length of the record at the index.
+        """
+        offset = OFFSET.unpack_from(self.map, HEADER.size + OFFSET.size * index)[0]
+        length = KEY_LENGTH.unpack_from(self.map, offset)[0]
+        start = offset + KEY_LENGTH.size
+        return self.map[start:start + length], start + length
+
+    def get(self, key, default=None):
+        """
+        Returns the value of the key, else default.
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            found, offset = self.key_at(middle)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                length = VALUE_LENGTH.unpack_from(self.map, offset)[0]
+                start = offset + VALUE_LENGTH.size
+                return self.map[start:start + length]
+        return default
+
+
+# The (generation, MappedTable) pair last opened by get_table, per name.
+_tables = {}
+
+
+def get_table(name, generation, items):
+    """
+    Returns the table of the given name for the given rules generation,
+    writing it first from the (key, value) pairs returned by calling
+    items if no process has yet. Tables of older generations are removed
+    once a new one is written; processes with them open keep their copy.
+    """
+    opened = _tables.get(name)
+    if opened is not None and opened[0] == generation:
+        return opened[1]
+    path = os.path.join(SNAPSHOT_DIR, "%s-%s.table" % (name, generation))
+    try:
+        table = MappedTable(path)
+    except IOError:
+        write_table(path, items())
+        table = MappedTable(path)
+        remove_tables(name, generation)
+    _tables[name] = (generation, table)
+    return table
+
+
+def remove_tables(name, generation):
+    """
+    Removes the tables of the given name from before the given generation.
+    """
+    prefix = os.path.join(SNAPSHOT_DIR, "%s-" % name)
+    for path in glob.glob(prefix + "*.table"):
+        try:
+            old_generation = int(path[len(prefix):-len(".table")])
+        except ValueError:
+            continue
+        if old_generation < generation:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def encode_key(key):
+    return unicode(key).encode('utf-8')
+
+
+class MappedIndex(object):
+    """
+    A snapshot index of the rules of a test model (see index_rules) held
+    in a MappedTable. Rules are rebuilt from the table as they are looked
+    up, without querying the database.
+    """
+
+    def __init__(self, model, table):
+        self.model = model
+        self.table = table
+
+    @staticmethod
+    def encode(rule):
+        """
+        Returns the rule as a value for the table.
+        """
+        fields = dict([(field.attname, getattr(rule, field.attname))
+                       for field in rule._meta.local_fields])
+        return simplejson.dumps(fields)
+
+    def get(self, key, default=None):
+        value = self.table.get(encode_key(key))
+        if value is None:
+            return default
+        fields = simplejson.loads(value)
+        return self.model(**dict([(str(name), value) for name, value
+                                  in fields.iteritems()]))
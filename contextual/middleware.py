@@ -1,11 +1,26 @@
+import codecs
 import re
+import time
+
 from django.conf import settings
 from django.core.cache import cache
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.hashcompat import md5_constructor
+from django.utils.cache import cc_delim_re, patch_vary_headers
+from django.utils.http import parse_etags
 
-from contextual import LOADED_TESTS
-from contextual.defaults import SESSION_KEY
-from contextual.models import ReplacementTag
+from contextual import get_tests
+from contextual.defaults import (DECISION_CACHE_SIZE, EXCLUDE_PREFIXES, PAGE_CACHE_KEY_PREFIX,
+        PAGE_CACHE_TIMEOUT, SESSION_KEY, TAGLESS_VIEW_CACHE_SIZE, TAGLESS_VIEW_THRESHOLD,
+        VARIANT_COOKIE)
+from contextual.engine import is_byte_safe
+from contextual.fingerprints import get_features, request_fingerprint
+from contextual.generation import current_generation
+from contextual.lru import LRUCache
+from contextual.resolver import resolve
+from contextual.rules import get_ruleset, request_variant
+from contextual.stats import get_stats
 
 class ContextualMiddleware(object):
     """
@@ -14,21 +29,62 @@ class ContextualMiddleware(object):
     of response data during process_response. 
     """
 
+    def __init__(self):
+        # Compiled on first use, see get_exclusions.
+        self.exclusions = None
+        # None disables the page cache, see get_cached_response.
+        self.page_cache_timeout = PAGE_CACHE_TIMEOUT
+        # None disables learning which views are tagless, see is_tagless.
+        self.tagless_threshold = TAGLESS_VIEW_THRESHOLD
+        self.tagless_cache_size = TAGLESS_VIEW_CACHE_SIZE
+        # The (generation, counts) pair of get_tagless_counts.
+        self.tagless_counts = None
+        # None disables the variant cookie, see add_variant_headers.
+        self.variant_cookie = VARIANT_COOKIE
+        self.decision_cache_size = DECISION_CACHE_SIZE
+        # The (generation, LRUCache) pair of get_decision_cache.
+        self.decision_cache = None
+
     def is_excludable(self, request):
         """
         Returns True if the request should be excluded
         from any contextual lookup or replacements.
         """
-        # For those serving media via django for development purposes;
-        # this stops us from processing the media requests. Also 
-        # stops it from working for admin requests. We also
-        # set a flag on the request so we can faster decide whether
-        # or not to process in the response.
-        return any([
-            hasattr(request, 'contextual_excluded'),
-            request.path.startswith(settings.MEDIA_URL),
-            request.path.startswith(reverse('admin:index'))
-        ])
+        # We set a flag on the request so we can faster decide
+        # whether or not to process in the response.
+        excluded = getattr(request, 'contextual_excluded', None)
+        if excluded is None:
+            excluded = self.get_exclusions().match(request.path) is not None
+            request.contextual_excluded = excluded
+        return excluded
+
+    def get_exclusions(self):
+        """
+        Returns the compiled pattern matching the start of any path
+        we should exclude. For those serving media via django for
+        development purposes; this stops us from processing the media
+        requests. Also stops it from working for admin requests and
+        any prefixes set in the CONTEXTUAL_EXCLUDE_PREFIXES setting.
+        """
+        if self.exclusions is None:
+            prefixes = [getattr(settings, 'MEDIA_URL', None),
+                        getattr(settings, 'STATIC_URL', None)]
+            try:
+                prefixes.append(reverse('admin:index'))
+            except NoReverseMatch:
+                # The admin isn't in use.
+                pass
+            prefixes.extend(EXCLUDE_PREFIXES)
+            # Empty prefixes would exclude everything, full URLs can't match.
+            prefixes = [prefix for prefix in prefixes if prefix and
+                        prefix.startswith('/')]
+            if prefixes:
+                self.exclusions = re.compile("|".join([re.escape(prefix)
+                                                       for prefix in prefixes]))
+            else:
+                # Never matches anything.
+                self.exclusions = re.compile("(?!)")
+        return self.exclusions
 
     def is_overrideable(self, request):
         """
@@ -46,10 +102,9 @@ class ContextualMiddleware(object):
         to the response.
         """
         if self.is_excludable(request):
-            # Set a flag so we can exclude this request faster
-            # in the future (e.g during the response).
-            request.contextual_excluded = True
             return None
+        if self.tagless_threshold:
+            request.contextual_view = self.get_view_key(view_func, view_args, view_kwargs)
         # Before we run the tests to check whether we have a match,
         # we check to see if we ALREADY have a match on the session.
         # We recommend the use of the cache backend for the session
@@ -57,23 +112,143 @@ class ContextualMiddleware(object):
         # serious persistence however, you may). If we have a match
         # we also check whether the incoming request *should* override
         # the stored match. This relies on the test classes themselves.
-        if SESSION_KEY in request.session and not self.is_overrideable(request):
-            # We found a match, load on to the request and dump out.
-            request.contextual_test = request.session.get(SESSION_KEY)
-            return None
-        # We now loop through the loaded tests, checking with each
-        # one to see if it returns a match. As the tests are loaded
-        # with a priority we can break out as soon as we find a match.
-        for loaded_test in LOADED_TESTS:
-            test_match = loaded_test.test(request)
-            if test_match:
+        # With the variant cookie the match is kept there instead. Reading
+        # the session would have it say Vary: Cookie, and shared caches
+        # would keep a copy per visitor rather than per variant.
+        if self.variant_cookie:
+            variant = get_ruleset().keyed_variant(request.COOKIES.get(self.variant_cookie))
+        else:
+            token = request.session.get(SESSION_KEY)
+            variant = None
+            if isinstance(token, basestring):
+                # The session only holds a short token for the matched
+                # rule which we resolve against the in-memory rules.
+                variant = get_ruleset().variant(token)
+        stats = get_stats()
+        if variant is not None and not self.is_overrideable(request):
+            if stats.enabled:
+                stats.incr("session.hits")
+            # We found a match, load its variant on to the request.
+            request.contextual_variant = variant
+        else:
+            if stats.enabled:
+                stats.incr("session.misses")
+            # We now run through the loaded tests, checking with each
+            # one to see if it returns a match. As the tests are loaded
+            # with a priority we stop as soon as we find a match.
+            token = self.decide(request)
+            if token is not None:
                 # If we found a matching test, then deal with it!
-                request.contextual_test = test_match
-                # We also store on the session to future lookups
-                # retain the same contextual data as the first
-                # incoming request. TODO: Override functionality.
-                request.session[SESSION_KEY] = test_match
-                return None
+                request.contextual_variant = get_ruleset().variant(token)
+                # We also store the token on the session so future
+                # lookups retain the same contextual data as the first
+                # incoming request (the variant cookie is set along with
+                # the response). TODO: Override functionality.
+                if not self.variant_cookie:
+                    request.session[SESSION_KEY] = token
+        # Now we know the variant, the page may already be cached.
+        return self.get_cached_response(request, view_func)
+
+    def decide(self, request):
+        """
+        Returns the token of the rule the request matches, else None.
+        The outcome for requests which look the same to every test, by
+        their fingerprint, is remembered until the rules change.
+        """
+        tests = get_tests()
+        features = None
+        if self.decision_cache_size:
+            features = get_features(tests)
+        if features is None:
+            return resolve(tests, request)
+        fingerprint = request_fingerprint(request, features)
+        decision_cache = self.get_decision_cache()
+        token = decision_cache.get(fingerprint, NotImplemented)
+        stats = get_stats()
+        if stats.enabled:
+            stats.incr(token is NotImplemented and "decision_cache.misses" or
+                       "decision_cache.hits")
+        if token is NotImplemented:
+            token = resolve(tests, request)
+            decision_cache.set(fingerprint, token)
+        return token
+
+    def get_decision_cache(self):
+        """
+        Returns the LRUCache of request fingerprint to the token of
+        the matching rule, or None for no match, replaced by an empty
+        one whenever the rules change.
+        """
+        generation = current_generation()
+        decision_cache = self.decision_cache
+        if decision_cache is None or decision_cache[0] != generation:
+            decision_cache = (generation, LRUCache(self.decision_cache_size))
+            self.decision_cache = decision_cache
+        return decision_cache[1]
+
+    def get_page_cache_key(self, request, variant, generation):
+        """
+        Returns the cache key of the rewritten page for the request,
+        which is unique to its URL, the variant and the rules
+        generation; stored pages are never served once rules change.
+        """
+        url = md5_constructor(request.get_host() + request.get_full_path())
+        return "%s:%s:%s:%s" % (PAGE_CACHE_KEY_PREFIX, generation,
+                                variant.token or "", url.hexdigest())
+
+    def get_cached_response(self, request, view_func):
+        """
+        Returns the cached rewritten page for the request, if there is
+        one, else None. Requests whose page could be cached, but isn't yet,
+        are given the key to store it under as contextual_cache_key.
+        """
+        if self.page_cache_timeout is None or \
+                request.method not in ('GET', 'HEAD') or \
+                getattr(view_func, 'contextual_page_cache_exempt', False):
+            return None
+        ruleset = get_ruleset()
+        variant = getattr(request, 'contextual_variant', ruleset.default_variant)
+        key = self.get_page_cache_key(request, variant, ruleset.generation)
+        cached = cache.get(key)
+        stats = get_stats()
+        if stats.enabled:
+            stats.incr(cached is None and "page_cache.misses" or "page_cache.hits")
+        if cached is None:
+            request.contextual_cache_key = key
+            return None
+        content, headers = cached
+        response = HttpResponse(content)
+        for header, value in headers:
+            response[header] = value
+        # It was rewritten before it was stored.
+        response.contextual_processed = True
+        if response.has_header('ETag') and self.is_not_modified(request, response['ETag']):
+            return self.not_modified(response)
+        return response
+
+    def cache_response(self, request, response):
+        """
+        Stores the rewritten response in the page cache, unless
+        the response is private or otherwise shouldn't be stored.
+        """
+        key = getattr(request, 'contextual_cache_key', None)
+        if key is None or request.method != 'GET' or \
+                response.status_code != 200 or response.cookies or \
+                'html' not in response['Content-Type'] or self.is_streaming(response):
+            return
+        if response.has_header('Cache-Control'):
+            for directive in response['Cache-Control'].split(','):
+                directive = directive.strip().lower().replace(' ', '')
+                if directive in ('private', 'no-store', 'no-cache', 'max-age=0'):
+                    return
+        if response.has_header('Vary'):
+            # The key tells apart nothing but URLs and variants; pages
+            # varying on anything else, e.g. Accept-Language or Cookie
+            # (per user), would be mixed up.
+            for header in cc_delim_re.split(response['Vary']):
+                if header.strip().lower() != 'x-contextual-variant':
+                    return
+        cache.set(key, (response.content, response.items()), self.page_cache_timeout)
 
     def process_response(self, request, response):
         """
@@ -82,46 +257,271 @@ class ContextualMiddleware(object):
         """
         if self.is_excludable(request):
             return response
+        # Pages served from the page cache were rewritten already, as
+        # were those whose tags were replaced while rendering. The
+        # latter can still be cached.
+        if getattr(response, 'contextual_processed', False):
+            if self.variant_cookie and 'html' in response['Content-Type']:
+                self.add_variant_headers(request, response, request_variant(request))
+            self.cache_response(request, response)
+            return response
         # We check to make sure 'html' is in the content-type of
         # the response so that we don't fiddle with responses
         # we do not wish to touch. I think this is OK but please
         # point out an edge case if there is one.
-        if 'html' in response['content-type']:
-            # Get a cached copy of all the tags available or refresh cache.
-            all_tags = cache.get('all_tags')
-            if all_tags is None:
-                all_tags = ReplacementTag.objects.all()
-                cache.set('all_tags', all_tags, 300)
-            if hasattr(request, 'contextual_test'):
-                # We have to calculate which tags to use our contextual_test match
-                # replacement data for and which ones to use the default replacement
-                # text for. This is so we never get a tag going unreplaced. TODO: cache!
-                replacements = request.contextual_test.replacements.filter(
-                                                active=True, tag__in=all_tags)
-                req_tags = [replacement.tag for replacement in replacements] 
+        # Nor do we touch content which has already been compressed.
+        if 'html' in response['content-type'] and \
+                not response.has_header('Content-Encoding'):
+            # The tags, their defaults and the compiled engine are only
+            # rebuilt when the rules generation moves on.
+            ruleset = get_ruleset()
+            charset = self.get_charset(response)
+            streaming = self.is_streaming(response)
+            # Most pages hold no tags at all; those are left as they are,
+            # upstream ETag and all, with no more work than a scan.
+            if not streaming and self.is_tagless(request, response, ruleset, charset):
+                if self.variant_cookie:
+                    # The page is the same for everyone, but the visitor's
+                    # variant should still be known for the pages to come.
+                    self.set_variant_cookie(request, response, request_variant(request))
+                stats = get_stats()
+                if stats.enabled:
+                    stats.incr("response.tagless")
+                self.cache_response(request, response)
+                return response
+            # Requests which matched nothing get the default variant.
+            variant = request_variant(request)
+            if self.variant_cookie:
+                self.add_variant_headers(request, response, variant)
+            # The upstream ETag no longer describes the body once rewritten,
+            # so we derive one which does; the client may have it already.
+            etag = self.get_etag(response, variant, ruleset.generation)
+            if etag is not None:
+                response['ETag'] = etag
+                if self.is_not_modified(request, etag):
+                    return self.not_modified(response)
+            # Where we can, we work on the encoded content directly with
+            # the tags and replacements encoded to match, saving on
+            # decoding and re-encoding the whole of the content.
+            if is_byte_safe(charset):
+                engine = ruleset.engine.encoded(charset)
+                replacements = variant.encoded(engine)
+            else:
+                engine = ruleset.engine
+                replacements = variant.replacements
+            if streaming:
+                response = self.rewrite_streaming_response(response, engine,
+                                                           replacements, charset)
             else:
-                replacements = []
-                req_tags = []
-            # To get the defaults we want all replacements that are possible
-            # minus the ones that are set on the request.
-            defaults = set(all_tags) - set(req_tags)
-            # Carry out the replacements for the defaults, if any,
-            # and then the replacements we found a match for.
-            for default in defaults:
-                response = self.rewrite_response(response, default.raw_tag, 
-                                                 default.default)
-            for replacement in replacements:
-                response = self.rewrite_response(response, replacement.tag.raw_tag,
-                                                 replacement.data)
+                stats = get_stats()
+                if stats.enabled:
+                    start = time.time()
+                response = self.rewrite_response(response, engine,
+                                                 replacements, charset)
+                if stats.enabled:
+                    stats.timing("response.rewrite.time", time.time() - start)
+                    stats.incr("response.rewrites")
+                self.cache_response(request, response)
         return response
 
-    def rewrite_response(self, response, raw_tag, replacement):
+    def get_view_key(self, view_func, view_args, view_kwargs):
+        """
+        Returns the key the tagless responses of the view are counted
+        under; its arguments are part of it as one view (e.g. a generic
+        view such as direct_to_template) may serve all sorts of pages.
+        """
+        name = "%s.%s" % (getattr(view_func, '__module__', ''),
+                          getattr(view_func, '__name__', view_func.__class__.__name__))
+        kwargs = sorted(view_kwargs.items())
+        return md5_constructor(repr((name, tuple(view_args), kwargs))).digest()
+
+    def is_tagless(self, request, response, ruleset, charset):
+        """
+        Returns True if the (non-streaming) response holds no tags, or is
+        from a view whose last CONTEXTUAL_TAGLESS_VIEW_THRESHOLD responses
+        held none, in which case it isn't even scanned.
+        """
+        if ruleset.engine.pattern is None:
+            return True
+        view = getattr(request, 'contextual_view', None)
+        counts = None
+        if view is not None and self.tagless_threshold:
+            counts = self.get_tagless_counts(ruleset.generation)
+            if counts.get(view, 0) >= self.tagless_threshold:
+                return True
+        # Otherwise we find out when rewriting.
+        tagless = is_byte_safe(charset) and \
+                  not ruleset.engine.encoded(charset).contains_tags(response.content)
+        if counts is not None:
+            counts.set(view, tagless and counts.get(view, 0) + 1 or 0)
+        return tagless
+
+    def get_tagless_counts(self, generation):
         """
-        Given a response, a tag and some replacement data,
-        this method carries out the regex substitution
-        and returns the response.
+        Returns the LRUCache of view key (see get_view_key) to the number
+        of responses in a row from it without tags, started afresh when
+        the rules change.
         """
-        response.content = re.sub(raw_tag, replacement,
-                                  response.content.decode('utf-8'),
-                                  re.UNICODE)
+        tagless_counts = self.tagless_counts
+        if tagless_counts is None or tagless_counts[0] != generation:
+            tagless_counts = (generation, LRUCache(self.tagless_cache_size))
+            self.tagless_counts = tagless_counts
+        return tagless_counts[1]
+
+    def add_variant_headers(self, request, response, variant):
+        """
+        Marks the response as one version of many, one per variant: its
+        X-Contextual-Variant header holds the variant's key and it varies
+        on the X-Contextual-Variant request header, which a shared cache
+        in front should set from the variant cookie.
+        """
+        response['X-Contextual-Variant'] = variant.key
+        patch_vary_headers(response, ('X-Contextual-Variant',))
+        self.set_variant_cookie(request, response, variant)
+
+    def set_variant_cookie(self, request, response, variant):
+        """
+        Sets the variant cookie to the key of the variant, unless
+        it holds that already; a response setting a cookie is one
+        a shared cache won't store.
+        """
+        if request.COOKIES.get(self.variant_cookie) != variant.key:
+            response.set_cookie(self.variant_cookie, variant.key,
+                                max_age=settings.SESSION_COOKIE_AGE,
+                                domain=settings.SESSION_COOKIE_DOMAIN)
+
+    def rewrite_response(self, response, engine, replacement_map, charset):
+        """
+        Given a response, the replacement engine and a dictionary
+        of tag to replacement data, this method carries out every
+        substitution in a single pass and returns the response.
+        """
+        if engine.charset:
+            response.content = engine.rewrite(response.content, replacement_map)
+        else:
+            content = response.content.decode(charset, 'replace')
+            response.content = engine.rewrite(content, replacement_map).encode(charset)
+        response['Content-Length'] = str(len(response.content))
+        return response
+
+    def get_etag(self, response, variant, generation):
+        """
+        Returns the ETag of the rewritten response, derived from its
+        upstream ETag, the variant and the rules generation, else None
+        if there is no upstream ETag. Weak ETags stay weak.
+        """
+        if not response.has_header('ETag'):
+            return None
+        upstream = response['ETag']
+        digest = md5_constructor("%s:%s:%s" % (upstream, variant.token or "",
+                                               generation)).hexdigest()
+        if upstream.startswith('W/'):
+            return 'W/"%s"' % digest
+        return '"%s"' % digest
+
+    def is_not_modified(self, request, etag):
+        """
+        Returns True if the request is a conditional GET (or HEAD)
+        whose If-None-Match holds the given ETag.
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if not if_none_match:
+            return False
+        etags = parse_etags(if_none_match)
+        return '*' in etags or parse_etags(etag)[0] in etags
+
+    def not_modified(self, response):
+        """
+        Returns the 304 Not Modified response standing in for
+        the response, carrying over its caching headers.
+        """
+        not_modified = HttpResponseNotModified()
+        for header in ('ETag', 'Cache-Control', 'Expires', 'Vary', 'Last-Modified'):
+            if response.has_header(header):
+                not_modified[header] = response[header]
+        not_modified.contextual_processed = True
+        return not_modified
+
+    def is_streaming(self, response):
+        """
+        Returns True if the response's content is an iterator which
+        we should rewrite as it is consumed rather than all at once.
+        """
+        # Newer Django has a dedicated streaming response class, older
+        # versions stream any response given an iterator as content.
+        return getattr(response, 'streaming', False) or \
+               not getattr(response, '_is_string', True)
+
+    def rewrite_streaming_response(self, response, engine, replacement_map, charset):
+        """
+        Wraps the content iterator of a streaming response so its
+        chunks are rewritten one by one as they are sent. The
+        response keeps streaming and is never held in memory.
+        """
+        if engine.charset:
+            # The engine works on the encoded chunks as they are.
+            def prepare(chunks):
+                try:
+                    for chunk in chunks:
+                        if isinstance(chunk, unicode):
+                            chunk = chunk.encode(charset)
+                        yield chunk
+                finally:
+                    if hasattr(chunks, 'close'):
+                        chunks.close()
+        else:
+            decoder = codecs.getincrementaldecoder(charset)('replace')
+            def prepare(chunks):
+                try:
+                    for chunk in chunks:
+                        if isinstance(chunk, str):
+                            chunk = decoder.decode(chunk)
+                        yield chunk
+                    tail = decoder.decode('', True)
+                    if tail:
+                        yield tail
+                finally:
+                    if hasattr(chunks, 'close'):
+                        chunks.close()
+        def rewrite(chunks):
+            stream = engine.rewrite_stream(prepare(chunks), replacement_map)
+            if engine.charset:
+                return stream
+            return self.encode_stream(stream, charset)
+        if getattr(response, 'streaming', False):
+            response.streaming_content = rewrite(response.streaming_content)
+        else:
+            response._container = rewrite(response._container)
+        # The rewritten length can't be known up front.
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
         return response
+
+    def encode_stream(self, stream, charset):
+        """
+        Generator which encodes the chunks of a text stream.
+        """
+        encoder = codecs.getincrementalencoder(charset)()
+        try:
+            for chunk in stream:
+                yield encoder.encode(chunk)
+        finally:
+            stream.close()
+
+    def get_charset(self, response):
+        """
+        Returns the charset of the response as given by
+        its Content-Type, else the default charset.
+        """
+        for param in response['Content-Type'].split(';')[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'charset' and value.strip():
+                charset = value.strip().strip('"')
+                try:
+                    codecs.lookup(charset)
+                except LookupError:
+                    break
+                return charset
+        return settings.DEFAULT_CHARSET
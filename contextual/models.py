@@ -1,6 +1,7 @@
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
+from contextual.generation import watch_model
 from contextual.managers import ActiveManager
 
 
@@ -48,3 +49,13 @@ class ReplacementTag(models.Model):
     @property
     def raw_tag(self):
         return r"\[%s\]" % self.tag
+
+
+# Changes to tags or their data invalidate anything built from them.
+watch_model(ReplacementData)
+watch_model(ReplacementTag)
+
+# As do changes to the rules of the configured tests, whose models are
+# registered now though the tests themselves are only loaded on first use.
+from contextual import register_test_models
+register_test_models()
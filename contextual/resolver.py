@@ -0,0 +1,113 @@
+"""
+Runs the loaded tests against a request to find the matching rule.
+
+The tests which query the database, rather than using in-memory snapshots,
+are resolved in a single round trip: each test contributes a query for its
+candidate rules and the candidates of every test are fetched together
+with one UNION ALL, leaving the priority order to be applied in Python.
+"""
+import time
+
+from django.db import connections
+
+from contextual.rules import model_token, rule_token
+from contextual.stats import get_stats
+
+
+def fetch_candidates(queries):
+    """
+    Given a list of (position, test, queryset) triplets, returns a dictionary
+    of position to the list of (pk, query_key value) candidate pairs found by
+    the queryset. Issues one query per database used, usually just the one.
+    """
+    by_database = {}
+    for position, test, queryset in queries:
+        by_database.setdefault(queryset.db, []).append((position, test, queryset))
+    candidates = {}
+    for database, queries in by_database.iteritems():
+        connection = connections[database]
+        selects = []
+        params = []
+        for position, test, queryset in queries:
+            if test.query_key:
+                queryset = queryset.values_list('pk', test.query_key)
+                columns = "U%d.*" % position
+            else:
+                queryset = queryset.values_list('pk')
+                columns = "U%d.*, NULL" % position
+            sql, query_params = queryset.query.get_compiler(
+                                    connection=connection).as_sql()
+            selects.append("SELECT %d, %s FROM (%s) U%d" % (position, columns,
+                                                           sql, position))
+            params.extend(query_params)
+        cursor = connection.cursor()
+        cursor.execute(" UNION ALL ".join(selects), params)
+        for position, pk, key in cursor.fetchall():
+            candidates.setdefault(position, []).append((pk, key))
+    return candidates
+
+
+def resolve(tests, request):
+    """
+    Runs the tests against the request in priority order, first match wins,
+    and returns the token of the matching rule, else None. The candidates
+    of every test not using its snapshot are fetched together, and only
+    once a test needing them is reached. Those tests remember the
+    outcome of recent lookups (see BaseTest.lookup_key) and skip
+    the database for any they have seen before.
+    """
+    queries = []
+    direct = set()
+    # The outcomes (token or None) of recent lookups, by position.
+    remembered = {}
+    keys = {}
+    for position, test in enumerate(tests):
+        if test.use_snapshot:
+            direct.add(position)
+            continue
+        key = test.lookup_key(request)
+        if key is not None:
+            token = test.get_lookup_cache().get(key, NotImplemented)
+            if token is not NotImplemented:
+                remembered[position] = token
+                continue
+        queryset = test.query(request)
+        if queryset is NotImplemented:
+            direct.add(position)
+        elif queryset is not None:
+            queries.append((position, test, queryset))
+            keys[position] = key
+    models = dict([(position, queryset.model)
+                   for position, test, queryset in queries])
+    candidates = None
+    for position, test in enumerate(tests):
+        stats = get_stats()
+        if position in direct:
+            match = test.test(request)
+            if match:
+                return rule_token(match)
+        elif position in remembered:
+            if stats.enabled:
+                stats.incr("test.%s.lookup_cache.hits" % test.__class__.__name__)
+            if remembered[position] is not None:
+                return remembered[position]
+        elif position in models:
+            if candidates is None:
+                start = time.time()
+                candidates = fetch_candidates(queries)
+                if stats.enabled:
+                    stats.timing("resolver.batch.time", time.time() - start)
+            pk = test.choose(candidates.get(position, []), request)
+            if stats.enabled:
+                name = "test.%s" % test.__class__.__name__
+                stats.incr(name + ".calls")
+                if pk is not None:
+                    stats.incr(name + ".matches")
+            token = None
+            if pk is not None:
+                token = model_token(models[position], pk)
+            if keys[position] is not None:
+                test.get_lookup_cache().set(keys[position], token)
+            if token is not None:
+                return token
+    return None
@@ -0,0 +1,262 @@
+"""
+Reading and writing the rules of a test model, along with the replacement
+data linked to each, as CSV or JSON lines; for moving rules in and out in
+bulk (see the importrules and exportrules commands) far quicker than
+saving them one at a time.
+
+Each rule is a row of its fields (all bar the pk) and a 'replacements'
+column listing its replacement data as TAG=data items, separated by '|'
+in CSV and as a list in JSON lines. Rules are matched up with existing
+ones on their unique field(s): existing rules are updated, others created.
+"""
+import csv
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import simplejson
+
+from contextual.generation import (bump_generation, resume_invalidation,
+        suspend_invalidation)
+from contextual.models import ReplacementData, ReplacementTag
+
+FORMATS = ('csv', 'jsonl')
+
+
+def rule_fields(model):
+    """
+    Returns the fields of the test model which are read and written.
+    """
+    return [field for field in model._meta.local_fields if not field.primary_key]
+
+
+def key_fields(model):
+    """
+    Returns the fields which together identify a rule of the test model;
+    its unique field, else its first set of unique_together fields.
+    """
+    fields = [field for field in rule_fields(model) if field.unique]
+    if fields:
+        return fields[:1]
+    if model._meta.unique_together:
+        return [model._meta.get_field(name) for name in model._meta.unique_together[0]]
+    raise ValueError("%s has no unique fields to match rules up on." %
+                     model._meta.object_name)
+
+
+def read_rules(stream, format):
+    """
+    Generator of the rules, as dictionaries of field name to value with
+    the replacements as a list, read from the stream one row at a time.
+    """
+    if format == 'csv':
+        for row in csv.DictReader(stream):
+            rule = dict([(name, value.decode('utf-8')) for name, value
+                         in row.iteritems() if value is not None])
+            if 'replacements' in rule:
+                rule['replacements'] = [item for item in
+                                        rule['replacements'].split('|') if item]
+            yield rule
+    else:
+        for line in stream:
+            if line.strip():
+                yield simplejson.loads(line)
+
+
+def write_rules(stream, format, model, rules):
+    """
+    Writes the rules (as yielded by export_rules)
+    of the test model to the stream as they come.
+    """
+    if format == 'csv':
+        names = [field.name for field in rule_fields(model)] + ['replacements']
+        writer = csv.writer(stream)
+        writer.writerow(names)
+        for rule in rules:
+            rule['replacements'] = u"|".join(rule['replacements'])
+            writer.writerow([unicode(rule[name]).encode('utf-8') for name in names])
+    else:
+        for rule in rules:
+            stream.write(simplejson.dumps(rule) + "\n")
+
+
+def export_rules(model, batch_size=500):
+    """
+    Generator of every rule of the test model, as a dictionary of field
+    name to value along with its replacements, fetched in batches.
+    """
+    fields = rule_fields(model)
+    replacements_field = model._meta.get_field('replacements')
+    source = replacements_field.m2m_field_name()
+    target = replacements_field.m2m_reverse_field_name()
+    last = None
+    while True:
+        queryset = model.objects.order_by('pk')
+        if last is not None:
+            queryset = queryset.filter(pk__gt=last)
+        rules = list(queryset[:batch_size])
+        if not rules:
+            break
+        last = rules[-1].pk
+        replacements = {}
+        for pk, tag, data in replacements_field.rel.through.objects.filter(
+                **{'%s__in' % source: [rule.pk for rule in rules]}
+                ).order_by('%s__tag__tag' % target, '%s__data' % target).values_list(
+                source, '%s__tag__tag' % target, '%s__data' % target):
+            replacements.setdefault(pk, []).append(u"%s=%s" % (tag, data))
+        for rule in rules:
+            values = dict([(field.name, getattr(rule, field.attname)) for field in fields])
+            values['replacements'] = replacements.get(rule.pk, [])
+            yield values
+
+
+class RuleImporter(object):
+    """
+    Imports rules into a test model in batches, each batch within
+    its own transaction and taking a handful of queries. Replacement
+    data named by the rules is created if need be; its tag must exist.
+    """
+
+    def __init__(self, model, batch_size=500):
+        self.model = model
+        self.batch_size = batch_size
+        self.fields = rule_fields(model)
+        self.key_fields = key_fields(model)
+        self.field = model._meta.get_field('replacements')
+        self.created = 0
+        self.updated = 0
+        # How many batches have been committed.
+        self.batches = 0
+        # (tag, data) to pk of every piece of replacement data.
+        self.data = dict([((tag, data), pk) for tag, data, pk in
+                          ReplacementData.all_objects.values_list('tag__tag', 'data', 'pk')])
+        self.tags = dict(ReplacementTag.objects.values_list('tag', 'pk'))
+
+    def run(self, rules):
+        """
+        Imports the rules, an iterable of dictionaries as yielded by
+        read_rules. The rules generation is only bumped once, at the end,
+        even should a batch fail; those before it are committed already.
+        """
+        suspend_invalidation()
+        try:
+            batch = []
+            for rule in rules:
+                batch.append(rule)
+                if len(batch) >= self.batch_size:
+                    self.import_batch(batch)
+                    self.batches += 1
+                    batch = []
+            if batch:
+                self.import_batch(batch)
+                self.batches += 1
+        finally:
+            if self.batches:
+                # Held back until the resume below.
+                bump_generation()
+            resume_invalidation()
+
+    @transaction.commit_on_success
+    def import_batch(self, batch):
+        rules = {}
+        for rule in batch:
+            values = {}
+            for field in self.fields:
+                if field.name in rule:
+                    try:
+                        values[field.attname] = field.to_python(rule[field.name])
+                    except ValidationError, e:
+                        raise ValueError("Rule %r has an invalid %s field: %s" %
+                                         (rule, field.name, "; ".join(e.messages)))
+                elif field.has_default():
+                    values[field.attname] = field.get_default()
+                else:
+                    raise ValueError("Rule %r is missing the %s field." %
+                                     (rule, field.name))
+            replacements = rule.get('replacements')
+            if replacements is not None:
+                replacements = [self.get_data(item) for item in replacements]
+            # The last of any duplicates wins.
+            rules[self.get_key(values)] = (values, replacements)
+        self.save_batch(rules)
+
+    def get_key(self, values):
+        return tuple([values[field.attname] for field in self.key_fields])
+
+    def get_data(self, item):
+        """
+        Returns the pk of the replacement data given as TAG=data.
+        """
+        if "=" not in item:
+            raise ValueError("Replacement %r is not of the form TAG=data." % item)
+        tag, data = item.split("=", 1)
+        pk = self.data.get((tag, data))
+        if pk is None:
+            if tag not in self.tags:
+                raise ValueError("Replacement tag %r does not exist." % tag)
+            pk = ReplacementData.objects.create(tag_id=self.tags[tag],
+                                                name=data, data=data).pk
+            self.data[(tag, data)] = pk
+        return pk
+
+    def existing(self, keys):
+        """
+        Returns a dictionary of key to (pk, values) of the
+        existing rules with any of the given keys.
+        """
+        existing = {}
+        if not keys:
+            return existing
+        if len(self.key_fields) == 1:
+            lookups = Q(**{'%s__in' % self.key_fields[0].attname:
+                           [key[0] for key in keys]})
+        else:
+            lookups = Q()
+            for key in keys:
+                lookups |= Q(**dict([(field.attname, value) for field, value
+                                     in zip(self.key_fields, key)]))
+        names = [field.attname for field in self.fields]
+        for row in self.model.objects.filter(lookups).values_list('pk', *names):
+            values = dict(zip(names, row[1:]))
+            existing[self.get_key(values)] = (row[0], values)
+        return existing
+
+    def save_batch(self, rules):
+        qn = connection.ops.quote_name
+        existing = self.existing(rules.keys())
+        inserts = []
+        for key, (values, replacements) in rules.iteritems():
+            if key in existing:
+                pk, current = existing[key]
+                if values != current:
+                    self.model.objects.filter(pk=pk).update(**values)
+                    self.updated += 1
+            else:
+                inserts.append([field.get_db_prep_save(values[field.attname],
+                                                       connection=connection)
+                                for field in self.fields])
+        cursor = connection.cursor()
+        if inserts:
+            cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+                    qn(self.model._meta.db_table),
+                    ", ".join([qn(field.column) for field in self.fields]),
+                    ", ".join(["%s"] * len(self.fields))), inserts)
+            self.created += len(inserts)
+            existing.update(self.existing([key for key in rules if key not in existing]))
+        # The replacements given for a rule replace any it had.
+        links = [(existing[key][0], replacements) for key, (values, replacements)
+                 in rules.iteritems() if replacements is not None]
+        if links:
+            table = qn(self.field.m2m_db_table())
+            source = qn(self.field.m2m_column_name())
+            target = qn(self.field.m2m_reverse_name())
+            pks = [pk for pk, replacements in links]
+            cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                    table, source, ", ".join(["%s"] * len(pks))), pks)
+            rows = []
+            for pk, replacements in links:
+                for data_pk in set(replacements):
+                    rows.append((pk, data_pk))
+            if rows:
+                cursor.executemany("INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (
+                        table, source, target), rows)
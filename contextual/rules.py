@@ -0,0 +1,236 @@
+"""
+The in-memory compilation of the replacement tags which the middleware
+works from. It is built once per rules generation by each process and
+swapped in whole, so requests never see a half built rule set.
+"""
+from django.core.exceptions import ValidationError
+from django.db.models import get_model
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+
+from contextual import test_model_snapshots, test_models
+from contextual.defaults import TESTS, USE_SNAPSHOTS
+from contextual.engine import ReplacementEngine
+from contextual.generation import current_generation
+from contextual.mapped import get_table, is_enabled
+from contextual.models import ReplacementTag
+
+
+def replacement_maps(model, pk=None):
+    """
+    Returns a dictionary of rule pk to a dictionary of tag to
+    replacement data for every rule of the given test model, or
+    just the one with the given pk, using a single query. Only
+    active replacement data is included and the first (by name)
+    for any one tag wins.
+    """
+    field = model._meta.get_field('replacements')
+    source = field.m2m_field_name()
+    target = field.m2m_reverse_field_name()
+    rows = field.rel.through.objects.filter(**{'%s__active' % target: True})
+    if pk is not None:
+        rows = rows.filter(**{source: pk})
+    rows = rows.order_by('%s__name' % target).values_list(
+                source, '%s__tag__tag' % target, '%s__data' % target)
+    maps = {}
+    for pk, tag, data in rows:
+        maps.setdefault(pk, {}).setdefault(tag, data)
+    return maps
+
+
+def variant_key(token):
+    """
+    Returns the key (see Variant) of the variant for the test
+    rule identified by the given token, None for no match.
+    """
+    if token is None:
+        return "default"
+    # 64 bits; shared caches store one copy per key, so keys of two
+    # rules mustn't collide, even among hundreds of thousands.
+    return md5_constructor(token).hexdigest()[:16]
+
+
+class Variant(object):
+    """
+    The final replacements for a single test rule, or for no match at all,
+    with the default of every tag not replaced by the rule merged in. Built
+    once per generation and shared by every request matching that rule.
+    """
+
+    def __init__(self, token, generation, replacements):
+        # The rule's token, None for the no match default.
+        self.token = token
+        # A short identifier of the variant which, unlike the token,
+        # gives nothing away and is the same in every process.
+        self.key = variant_key(token)
+        self.generation = generation
+        # Every available tag to its final replacement text.
+        self.replacements = replacements
+        # The replacements encoded per charset, see encoded().
+        self.encoded_replacements = {}
+
+    def encoded(self, engine):
+        """
+        Returns the replacements encoded for the given encoded
+        engine; only encoded once per charset.
+        """
+        replacements = self.encoded_replacements.get(engine.charset)
+        if replacements is None:
+            replacements = engine.encode_replacements(self.replacements)
+            self.encoded_replacements[engine.charset] = replacements
+        return replacements
+
+
+class RuleSet(object):
+    """
+    Everything the middleware needs to know about the available
+    tags for a single rules generation. Apart from the replacement
+    maps and variants, which are filled in on first use, it is
+    never mutated once built.
+    """
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.tags = tuple(ReplacementTag.objects.all())
+        # The default replacement text of every available tag.
+        self.defaults = dict([(tag.tag, tag.default) for tag in self.tags])
+        self.engine = ReplacementEngine(self.tags)
+        self.maps = {}
+        # Whether the tests of each model use their snapshots, see
+        # replacement_map.
+        self.snapshots = test_model_snapshots(TESTS)
+        self.default_variant = Variant(None, generation, self.defaults)
+        self.variants = {}
+        # The token of every rule by the key of its variant, see keyed_variant.
+        self.keys = None
+
+    def replacement_maps(self, model):
+        """
+        Returns the dictionary of rule pk to replacement map (tag to
+        replacement data) for the given test model; queried only once
+        per generation.
+        """
+        label = model._meta.object_name.lower()
+        maps = self.maps.get(label)
+        if maps is None:
+            maps = replacement_maps(model)
+            self.maps[label] = maps
+        return maps
+
+    def replacement_map(self, token):
+        """
+        Returns the replacement map of the test rule identified by
+        the given token (see rule_token). Unknown rules, such as
+        ones deleted since the token was handed out, have none.
+        The maps of every rule of the model are loaded together if
+        its tests use their snapshots, else just the one is queried.
+        """
+        label, pk = token.rsplit(":", 1)
+        model = get_model('contextual', label)
+        if model is None:
+            return {}
+        try:
+            pk = model._meta.pk.to_python(pk)
+        except ValidationError:
+            return {}
+        if label not in self.maps and \
+                not self.snapshots.get(model, USE_SNAPSHOTS):
+            return replacement_maps(model, pk).get(pk, {})
+        if is_enabled():
+            # Shared by every process rather than held by each.
+            def items():
+                return [(str(rule_pk), simplejson.dumps(replacement_map)) for rule_pk,
+                        replacement_map in self.replacement_maps(model).iteritems()]
+            table = get_table("%s-replacements" % label, self.generation, items)
+            replacement_map = table.get(str(pk))
+            if replacement_map is None:
+                return {}
+            return simplejson.loads(replacement_map)
+        return self.replacement_maps(model).get(pk, {})
+
+    def variant(self, token):
+        """
+        Returns the variant for the test rule identified by the given
+        token, or the default variant if the token is None.
+        """
+        if token is None:
+            return self.default_variant
+        variant = self.variants.get(token)
+        if variant is None:
+            replacements = self.defaults.copy()
+            for tag, data in self.replacement_map(token).iteritems():
+                if tag in replacements:
+                    replacements[tag] = data
+            variant = Variant(token, self.generation, replacements)
+            self.variants[token] = variant
+        return variant
+
+    def keyed_variant(self, key):
+        """
+        Returns the variant of the test rule whose variant has the given
+        key (see Variant), else None; None for the default variant's key
+        too, as that is no match to stick to. The keys of the rules of
+        every configured test are listed on first use.
+        """
+        if key is None or key == self.default_variant.key:
+            return None
+        keys = self.keys
+        if keys is None:
+            keys = {}
+            for model in test_models(TESTS):
+                for pk in model.objects.values_list('pk', flat=True):
+                    token = model_token(model, pk)
+                    rule_key = variant_key(token)
+                    # A key shared by two rules can't tell them apart.
+                    keys[rule_key] = rule_key not in keys and token or None
+            self.keys = keys
+        token = keys.get(key)
+        if token is None:
+            return None
+        return self.variant(token)
+
+
+def rule_token(rule):
+    """
+    Returns a short string identifying the given test rule which,
+    unlike the rule itself, is cheap to store on the session.
+    """
+    return model_token(rule.__class__, rule.pk)
+
+
+def model_token(model, pk):
+    """
+    Returns the token (see rule_token) for the rule
+    of the given test model with the given pk.
+    """
+    return "%s:%s" % (model._meta.object_name.lower(), pk)
+
+
+def request_variant(request):
+    """
+    Returns the variant matched for the request by the middleware,
+    the default variant if nothing matched. Should the rules have
+    changed mid-request the variant is resolved again.
+    """
+    ruleset = get_ruleset()
+    variant = getattr(request, 'contextual_variant', ruleset.default_variant)
+    if variant.generation != ruleset.generation:
+        variant = ruleset.variant(variant.token)
+    return variant
+
+
+_ruleset = None
+
+
+def get_ruleset():
+    """
+    Returns the rule set for the current generation,
+    building it first if the rules have changed.
+    """
+    global _ruleset
+    generation = current_generation()
+    ruleset = _ruleset
+    if ruleset is None or ruleset.generation != generation:
+        ruleset = RuleSet(generation)
+        _ruleset = ruleset
+    return ruleset
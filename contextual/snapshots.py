@@ -0,0 +1,28 @@
+"""
+Helpers for building the in-memory snapshots of the test models which
+the contextual tests do their lookups against. A snapshot is built once
+per rules generation and never mutated afterwards, so it can be shared
+by every request without locking.
+"""
+from contextual.mapped import MappedIndex, encode_key, get_table, is_enabled
+from contextual.rules import get_ruleset
+
+
+def index_rules(model, key, name=None):
+    """
+    Returns a dictionary of every rule of the given test model keyed by
+    the result of calling key with the rule.
+
+    If a name is given, and CONTEXTUAL_SNAPSHOT_DIR is set, the index
+    is instead a MappedIndex of that name shared by every process; its
+    keys must be strings and it only supports get.
+    """
+    if name is not None and is_enabled():
+        def items():
+            return [(encode_key(key(rule)), MappedIndex.encode(rule))
+                    for rule in model.objects.all()]
+        return MappedIndex(model, get_table(name, get_ruleset().generation, items))
+    index = {}
+    for rule in model.objects.all():
+        index.setdefault(key(rule), rule)
+    return index
@@ -0,0 +1,154 @@
+"""
+Pluggable statistics recorded by the tests and the middleware, e.g. how
+often and how long each test runs and how often it matches. Choose a
+backend with the CONTEXTUAL_STATS_BACKEND setting; by default nothing
+is recorded and the instrumentation costs nothing.
+"""
+import bisect
+import socket
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from contextual.defaults import STATS_BACKEND
+
+# The upper bounds (in seconds) of the buckets MemoryStats
+# sorts timings into; the last bucket holds anything slower.
+HISTOGRAM_BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+
+class BaseStats(object):
+    """
+    Subclass this to create your own stats backend. Backends
+    are shared between threads so should be thread safe.
+    """
+
+    # Checked before doing any of the work of recording.
+    enabled = True
+
+    def incr(self, name, count=1):
+        """
+        Increments the named counter.
+        """
+        raise NotImplementedError
+
+    def timing(self, name, seconds):
+        """
+        Records a single timing for the named timer.
+        """
+        raise NotImplementedError
+
+
+class NullStats(BaseStats):
+    """
+    Records nothing; the default.
+    """
+
+    enabled = False
+
+    def incr(self, name, count=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+
+class MemoryStats(BaseStats):
+    """
+    Keeps the counters and timings, the latter as a count, a total and
+    a histogram (see HISTOGRAM_BOUNDS), in memory for the process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, count=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + count
+        finally:
+            self.lock.release()
+
+    def timing(self, name, seconds):
+        self.lock.acquire()
+        try:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = {'count': 0, 'total': 0.0,
+                          'histogram': [0] * (len(HISTOGRAM_BOUNDS) + 1)}
+                self.timings[name] = timing
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['histogram'][bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+        finally:
+            self.lock.release()
+
+
+class StatsdStats(BaseStats):
+    """
+    Sends the counters and timings to a statsd server over UDP, as set
+    by the CONTEXTUAL_STATSD_HOST, _PORT and _PREFIX settings. To use
+    another statsd-style emitter subclass this and override send.
+    """
+
+    def __init__(self):
+        self.host = getattr(settings, 'CONTEXTUAL_STATSD_HOST', 'localhost')
+        self.port = getattr(settings, 'CONTEXTUAL_STATSD_PORT', 8125)
+        self.prefix = getattr(settings, 'CONTEXTUAL_STATSD_PREFIX', 'contextual')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        """
+        Sends a single line of statsd data. Failures are ignored;
+        stats should never break a request.
+        """
+        try:
+            self.socket.sendto(data, (self.host, self.port))
+        except socket.error:
+            pass
+
+    def incr(self, name, count=1):
+        self.send("%s.%s:%d|c" % (self.prefix, name, count))
+
+    def timing(self, name, seconds):
+        # Fractions of a millisecond matter for the sub-millisecond timers.
+        self.send("%s.%s:%.3f|ms" % (self.prefix, name, seconds * 1000))
+
+
+_stats = None
+
+
+def get_stats():
+    """
+    Returns the stats backend set by the CONTEXTUAL_STATS_BACKEND
+    setting, instantiating it on first use.
+    """
+    global _stats
+    if _stats is None:
+        if STATS_BACKEND is None:
+            _stats = NullStats()
+        else:
+            module_name, class_name = STATS_BACKEND.rsplit('.', 1)
+            try:
+                module = __import__(module_name, fromlist=[class_name])
+                klass = getattr(module, class_name)
+            except (ImportError, AttributeError), e:
+                raise ImproperlyConfigured("%s: check your CONTEXTUAL_STATS_BACKEND "
+                                           "setting." % e)
+            _stats = klass()
+    return _stats
+
+
+def set_stats(stats):
+    """
+    Replaces the stats backend in use, e.g. with one configured
+    differently to how the setting would have it.
+    """
+    global _stats
+    _stats = stats
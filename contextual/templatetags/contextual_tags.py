@@ -0,0 +1,41 @@
+from django import template
+
+from contextual.rules import request_variant
+
+register = template.Library()
+
+
+class ContextualNode(template.Node):
+
+    def __init__(self, tag):
+        self.tag = tag
+
+    def render(self, context):
+        tag = self.tag.resolve(context)
+        # Set by the contextual context processor, else from the request.
+        variant = context.get('contextual_variant')
+        if variant is None:
+            request = context.get('request')
+            if request is None:
+                return u""
+            variant = request_variant(request)
+        # Unknown tags are left as they are, as the middleware would.
+        return variant.replacements.get(tag, u"[%s]" % tag)
+
+
+@register.tag
+def contextual(parser, token):
+    """
+    Outputs the replacement text of the given tag for the variant
+    matched in the middleware, so the tag needn't be written out
+    and found again within the rendered page, e.g:
+
+        {% contextual "PHONE" %}
+
+    Needs either the contextual context processor or the request
+    in the context (django.core.context_processors.request).
+    """
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError("%r tag takes a single tag name." % bits[0])
+    return ContextualNode(parser.compile_filter(bits[1]))
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks for the middleware and each of the contextual tests, run
+against the same settings as the test suite (SQLite, in memory). Results
+are written as JSON so runs against different commits can be compared.
+
+    python run_benchmarks.py [--quick] [--output=benchmarks.json]
+"""
+import datetime
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+from django import VERSION as DJANGO_VERSION
+from django.conf import settings
+
+# If not running with the test settings already
+# configured, this will make sure they are.
+if not settings.configured:
+    settings.configure(
+        DATABASE_ENGINE='sqlite3',
+        DATABASE_NAME=':memory:',
+        INSTALLED_APPS=[
+            'contextual',
+            'contextual.tests',
+        ],
+        ROOT_URLCONF='contextual.tests.urls',
+    )
+
+BODY_SIZES = [1024, 10 * 1024, 100 * 1024, 1024 * 1024]
+TAG_COUNTS = [1, 10, 100, 500]
+RULE_COUNTS = [10, 1000, 10000, 100000]
+
+QUICK_BODY_SIZES = [1024, 100 * 1024]
+QUICK_TAG_COUNTS = [1, 50]
+QUICK_RULE_COUNTS = [10, 1000]
+
+# The shortest time (in seconds) a single benchmark runs for.
+MIN_TIME = 0.2
+
+
+def timed(func, min_time=MIN_TIME):
+    """
+    Calls func repeatedly for at least min_time seconds, three
+    times over, returning the best time per call of the three
+    and the total number of calls made.
+    """
+    best = None
+    total_calls = 0
+    for run in range(3):
+        calls = 0
+        start = time.time()
+        while True:
+            func()
+            calls += 1
+            elapsed = time.time() - start
+            if elapsed >= min_time / 3:
+                break
+        total_calls += calls
+        per_call = elapsed / calls
+        if best is None or per_call < best:
+            best = per_call
+    return best, total_calls
+
+
+class BenchmarkRunner(object):
+    """
+    Sets up the rules and requests for each benchmark
+    and records the time each one takes.
+    """
+
+    def __init__(self, body_sizes, tag_counts, rule_counts):
+        self.body_sizes = body_sizes
+        self.tag_counts = tag_counts
+        self.rule_counts = rule_counts
+        self.results = []
+
+    def record(self, name, params, func):
+        seconds, calls = timed(func)
+        self.results.append({
+            'benchmark': name,
+            'params': params,
+            'seconds_per_call': seconds,
+            'calls': calls,
+        })
+        print "%-40s %-55s %10.1fus" % (name, ", ".join(["%s=%s" % item for item
+                                        in sorted(params.items())]), seconds * 1e6)
+
+    def bulk_insert(self, model, columns, rows):
+        """
+        Inserts the rows straight into the model's table; far
+        quicker than saving each one through the ORM.
+        """
+        from django.db import connection, transaction
+        qn = connection.ops.quote_name
+        sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+                qn(model._meta.db_table),
+                ", ".join([qn(column) for column in columns]),
+                ", ".join(["%s"] * len(columns)))
+        cursor = connection.cursor()
+        cursor.executemany(sql, rows)
+        transaction.commit_unless_managed()
+
+    def clear_rules(self):
+        from contextual.contextual_models import (HostnameTestModel, PathTestModel,
+                QueryStringTestModel, RefererTestModel, BrandedSearchRefererTestModel)
+        from contextual.generation import bump_generation
+        from contextual.models import ReplacementData, ReplacementTag
+        for model in (HostnameTestModel, PathTestModel, QueryStringTestModel,
+                      RefererTestModel, BrandedSearchRefererTestModel,
+                      ReplacementData, ReplacementTag):
+            model.objects.all().delete()
+        bump_generation()
+
+    def create_tags(self, count):
+        """
+        Creates the given number of tags, each with
+        one piece of replacement data.
+        """
+        from contextual.generation import bump_generation
+        from contextual.models import ReplacementData, ReplacementTag
+        self.bulk_insert(ReplacementTag, ['tag', 'default'],
+                         [("TAG%d" % i, "default %d" % i) for i in range(count)])
+        tags = dict(ReplacementTag.objects.values_list('tag', 'pk'))
+        self.bulk_insert(ReplacementData, ['tag_id', 'name', 'data', 'active'],
+                         [(tags["TAG%d" % i], "data %d" % i, "replaced %d" % i, True)
+                          for i in range(count)])
+        bump_generation()
+        return ["TAG%d" % i for i in range(count)]
+
+    def create_rules(self, count):
+        """
+        Creates the given number of rules for each test
+        model, the first of each linked to some data.
+        """
+        from contextual.contextual_models import (HostnameTestModel, PathTestModel,
+                QueryStringTestModel, RefererTestModel, BrandedSearchRefererTestModel)
+        from contextual.generation import bump_generation
+        from contextual.models import ReplacementData
+        self.bulk_insert(HostnameTestModel, ['hostname'],
+                         [("www.host%d.com" % i,) for i in range(count)])
+        self.bulk_insert(PathTestModel, ['path', 'kind'],
+                         [("/path/%d/" % i, 'exact') for i in range(count)])
+        self.bulk_insert(QueryStringTestModel, ['value'],
+                         [("value%d" % i,) for i in range(count)])
+        self.bulk_insert(RefererTestModel, ['domain'],
+                         [("referer%d.com" % i,) for i in range(count)])
+        for engine in ('google', 'bing'):
+            for branded in (True, False):
+                BrandedSearchRefererTestModel.objects.create(
+                        search_engine=engine, branded=branded)
+        data = ReplacementData.objects.all()[0]
+        for model in (HostnameTestModel, PathTestModel, QueryStringTestModel,
+                      RefererTestModel, BrandedSearchRefererTestModel):
+            model.objects.all()[0].replacements.add(data)
+        bump_generation()
+
+    def make_body(self, size, tags):
+        """
+        Returns an HTML body of roughly the given size (in bytes)
+        with a tag, cycling through the given ones, every line.
+        """
+        lines = []
+        length = 0
+        i = 0
+        while length < size:
+            line = "<p>Some filler text for the page, call us on [%s] today.</p>\n" % \
+                    tags[i % len(tags)]
+            lines.append(line)
+            length += len(line)
+            i += 1
+        return "".join(lines)[:size]
+
+    def request(self, session=None, **environ):
+        from contextual.tests.tests import RequestFactory
+        request = RequestFactory().request(**environ)
+        request.session = session if session is not None else {}
+        return request
+
+    def run(self):
+        self.bench_load_tests()
+        for rule_count in self.rule_counts:
+            self.clear_rules()
+            self.create_tags(1)
+            self.create_rules(rule_count)
+            self.bench_tests(rule_count)
+            self.bench_process_view(rule_count)
+        for tag_count in self.tag_counts:
+            self.clear_rules()
+            tags = self.create_tags(tag_count)
+            self.create_rules(1)
+            for body_size in self.body_sizes:
+                self.bench_process_response(tag_count, body_size, tags)
+        return self.results
+
+    def bench_load_tests(self):
+        """
+        Times instantiating the configured tests, as
+        the middleware does on its first request.
+        """
+        from contextual import load_tests
+        from contextual.defaults import TESTS
+        self.record("load_tests", {'tests': len(TESTS)}, lambda: load_tests(TESTS))
+
+    def bench_tests(self, rule_count):
+        """
+        Times each contextual test on its own, both from its
+        snapshot and querying the database, for a hit and a miss.
+        Database lookups are timed without the lookup cache, and
+        again with it warmed up by the same request.
+        """
+        from contextual.contextual_tests import (HostnameTest, PathTest,
+                QueryStringTest, RefererTest, BrandedSearchRefererTest)
+        last = rule_count - 1
+        cases = [
+            (HostnameTest, {}, {'HTTP_HOST': "www.host%d.com" % last},
+                               {'HTTP_HOST': "www.nomatch.com"}),
+            (PathTest, {}, {'PATH_INFO': "/path/%d/" % last},
+                           {'PATH_INFO': "/nomatch/"}),
+            (QueryStringTest, {'get_key': 's'}, {'QUERY_STRING': "s=value%d" % last},
+                                                {'QUERY_STRING': "s=nomatch"}),
+            (RefererTest, {}, {'HTTP_REFERER': "http://www.referer%d.com/" % last},
+                              {'HTTP_REFERER': "http://www.nomatch.com/"}),
+            (BrandedSearchRefererTest, {'brand_terms': ["brand%d" % i for i in range(100)]},
+                {'HTTP_REFERER': "http://www.google.com/search?q=brand99"},
+                {'HTTP_REFERER': "http://www.ask.com/search?q=brand99"}),
+        ]
+        for klass, config, hit, miss in cases:
+            for use_snapshot in (True, False):
+                test_config = dict(config, use_snapshot=use_snapshot, lookup_cache_size=0)
+                test = klass(test_config)
+                for outcome, environ in (('hit', hit), ('miss', miss)):
+                    request = self.request(**environ)
+                    result = test.test(request)
+                    assert (result is not None) == (outcome == 'hit'), klass
+                    self.record("%s.test" % klass.__name__,
+                                {'rules': rule_count, 'snapshot': use_snapshot,
+                                 'outcome': outcome},
+                                lambda: test.test(request))
+            test = klass(dict(config, use_snapshot=False))
+            for outcome, environ in (('hit', hit), ('miss', miss)):
+                request = self.request(**environ)
+                test.test(request)
+                self.record("%s.test" % klass.__name__,
+                            {'rules': rule_count, 'snapshot': False,
+                             'outcome': outcome, 'lookup_cache': 'warm'},
+                            lambda: test.test(request))
+            test = klass(config)
+            self.record("%s.build_index" % klass.__name__, {'rules': rule_count},
+                        test.build_index)
+
+    def bench_process_view(self, rule_count):
+        """
+        Times the middleware's process_view for a session hit and
+        for session misses which do and don't match a rule. The misses
+        run the test chain every time, and again from the decision cache.
+        """
+        from contextual.defaults import DECISION_CACHE_SIZE, SESSION_KEY
+        from contextual.middleware import ContextualMiddleware
+        middleware = ContextualMiddleware()
+        environs = {
+            'miss-match': {'HTTP_HOST': "www.host%d.com" % (rule_count - 1)},
+            'miss-nomatch': {'HTTP_HOST': "www.nomatch.com",
+                             'HTTP_REFERER': "http://www.nomatch.com/"},
+        }
+        for session, environ in environs.items():
+            def process_view():
+                request = self.request(**environ)
+                middleware.process_view(request, None, (), {})
+            middleware.decision_cache_size = 0
+            process_view()
+            self.record("ContextualMiddleware.process_view",
+                        {'rules': rule_count, 'session': session}, process_view)
+            middleware.decision_cache_size = DECISION_CACHE_SIZE
+            process_view()
+            self.record("ContextualMiddleware.process_view",
+                        {'rules': rule_count, 'session': session,
+                         'decision_cache': 'hit'}, process_view)
+        request = self.request(**environs['miss-match'])
+        middleware.process_view(request, None, (), {})
+        session = {SESSION_KEY: request.session[SESSION_KEY]}
+        def process_view():
+            request = self.request(session=session)
+            middleware.process_view(request, None, (), {})
+        self.record("ContextualMiddleware.process_view",
+                    {'rules': rule_count, 'session': 'hit'}, process_view)
+
+    def bench_process_response(self, tag_count, body_size, tags):
+        """
+        Times the middleware's process_response rewriting
+        a body of the given size for a matched request.
+        """
+        from django.http import HttpResponse
+        from contextual.middleware import ContextualMiddleware
+        middleware = ContextualMiddleware()
+        body = self.make_body(body_size, tags)
+        request = self.request(HTTP_HOST="www.host0.com")
+        middleware.process_view(request, None, (), {})
+        def process_response():
+            middleware.process_response(request, HttpResponse(body))
+        process_response()
+        self.record("ContextualMiddleware.process_response",
+                    {'tags': tag_count, 'body_bytes': body_size}, process_response)
+        tagless = body.replace("[", "(")
+        def process_tagless_response():
+            middleware.process_response(request, HttpResponse(tagless))
+        self.record("ContextualMiddleware.process_response",
+                    {'tags': tag_count, 'body_bytes': body_size, 'tagless': True},
+                    process_tagless_response)
+
+
+def git_revision():
+    """
+    Returns the git commit being benchmarked, if it can be found.
+    """
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        output = process.communicate()[0].strip()
+    except OSError:
+        return None
+    return output or None
+
+
+def run_benchmarks():
+    parser = OptionParser(usage="%prog [--quick] [--output=FILE]")
+    parser.add_option('--quick', action='store_true', default=False,
+                      help="Run a reduced set of parameters.")
+    parser.add_option('--output', default='benchmarks.json',
+                      help="The file to write the JSON results to.")
+    options, args = parser.parse_args()
+    parent = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+    )
+    sys.path.insert(0, parent)
+    from django.db import connection
+    from django.utils import simplejson
+    connection.creation.create_test_db(verbosity=0)
+    if options.quick:
+        runner = BenchmarkRunner(QUICK_BODY_SIZES, QUICK_TAG_COUNTS, QUICK_RULE_COUNTS)
+    else:
+        runner = BenchmarkRunner(BODY_SIZES, TAG_COUNTS, RULE_COUNTS)
+    results = runner.run()
+    output = open(options.output, 'w')
+    simplejson.dump({
+        'revision': git_revision(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'python': sys.version.split()[0],
+        'django': ".".join([str(part) for part in DJANGO_VERSION[:3]]),
+        'results': results,
+    }, output, indent=2, sort_keys=True)
+    output.close()
+    print "Results written to %s" % options.output
+
+if __name__ == '__main__':
+    run_benchmarks()
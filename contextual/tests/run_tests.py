@@ -19,7 +19,8 @@ if not settings.configured:
         INSTALLED_APPS=[
             'contextual',
             'contextual.tests',
-        ]
+        ],
+        ROOT_URLCONF='contextual.tests.urls',
     )
 
 
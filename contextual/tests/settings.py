@@ -15,3 +15,5 @@ INSTALLED_APPS = (
     'contextual',
     'contextual.tests',
 )
+
+ROOT_URLCONF = 'contextual.tests.urls'
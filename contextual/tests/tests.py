@@ -1,14 +1,44 @@
-from django.core.exceptions import ImproperlyConfigured
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from StringIO import StringIO
+
+from django.conf import settings
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.signals import request_finished
+from django.core.management import call_command
 from django.core.handlers.wsgi import WSGIRequest
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.template import Context, Template, TemplateSyntaxError
 from django.test import TestCase
 from django.test import Client
+from django.utils.cache import patch_vary_headers
 
 from contextual.contextual_models import (HostnameTestModel, PathTestModel, 
         QueryStringTestModel, RefererTestModel, BrandedSearchRefererTestModel)
 from contextual.contextual_tests import (HostnameTest, PathTest, QueryStringTest, 
         RefererTest, BrandedSearchRefererTest)
-from contextual.defaults import DEFAULT_SEARCH_ENGINES
+from contextual.context_processors import contextual as contextual_processor
+from contextual.decorators import page_cache_exempt, replaced_when_rendered
+import contextual
+from contextual import generation, get_tests, test_models
+from contextual.defaults import DEFAULT_SEARCH_ENGINES, GENERATION_KEY, SESSION_KEY, TESTS
+from contextual.engine import ReplacementEngine, is_byte_safe
+from contextual.fingerprints import get_features, request_fingerprint
+from contextual.lru import LRUCache
+from contextual import mapped
+from contextual.mapped import MappedTable, write_table
+from contextual.middleware import ContextualMiddleware
 from contextual.models import ReplacementData, ReplacementTag
+from contextual.resolver import resolve
+from contextual.rulefiles import RuleImporter, export_rules, read_rules, write_rules
+from contextual.rules import get_ruleset, rule_token, variant_key
+from contextual.stats import MemoryStats, NullStats, StatsdStats, get_stats, set_stats
 
 default_environ = {
     'HTTP_HOST': 'www.example.com',
@@ -41,6 +71,20 @@ class RequestFactory(Client):
 
 class BaseTestCase(TestCase):
 
+    def count_queries(self, func, *args, **kwargs):
+        """
+        Calls func and returns a tuple of its result and
+        the number of database queries it issued.
+        """
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            result = func(*args, **kwargs)
+            return result, len(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+
     def setUp(self):
         """
         Create a bunch of replacement data and tags for the tests.
@@ -76,6 +120,923 @@ class GeneralTests(BaseTestCase):
         # Assert that the replacement data is indeed attached to the tag.
         assert self.tag_phone.replacement_data.all().count() == 3
 
+    def test_tests_loaded_lazily(self):
+        contextual._loaded_tests = None
+        tests = get_tests()
+        assert get_tests() is tests
+        assert [test.__class__ for test in tests] == \
+                [BrandedSearchRefererTest, RefererTest, QueryStringTest, HostnameTest]
+
+    def test_cold_imports(self):
+        # The middleware is loaded before any models by Django's handlers,
+        # custom tests import BaseTest likewise; neither may import cycle.
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path),
+                   DJANGO_SETTINGS_MODULE='contextual.tests.settings')
+        for module in ('contextual.middleware', 'contextual.contextual_tests',
+                       'contextual.rules', 'contextual.templatetags.contextual_tags'):
+            process = subprocess.Popen([sys.executable, '-c', 'import %s' % module],
+                                       env=env, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+            assert process.returncode == 0, "%s: %s" % (module, output)
+
+    def test_test_models(self):
+        assert test_models(TESTS + (('contextual.contextual_tests.HostnameTest', 5),)) == \
+                [BrandedSearchRefererTestModel, RefererTestModel,
+                 QueryStringTestModel, HostnameTestModel]
+        self.assertRaises(ImproperlyConfigured, test_models,
+                          (('contextual.missing.MissingTest', 1),))
+
+
+class ReplacementEngineTest(BaseTestCase):
+
+    def setUp(self):
+        super(ReplacementEngineTest, self).setUp()
+        self.tag_email = ReplacementTag.objects.create(tag="EMAIL",
+                                                       default="info@example.com")
+        self.engine = ReplacementEngine(ReplacementTag.objects.all())
+
+    def test_single_pass_replaces_all_tags(self):
+        content = u"Call [PHONE] or mail [EMAIL]. Again: [PHONE]"
+        replacements = {'PHONE': u"0800 HOST", 'EMAIL': u"me@example.com"}
+        assert self.engine.rewrite(content, replacements) == \
+                u"Call 0800 HOST or mail me@example.com. Again: 0800 HOST"
+
+    def test_contains_tags(self):
+        assert self.engine.contains_tags(u"Call [PHONE]")
+        assert not self.engine.contains_tags(u"var a = [1, 2]; [UNKNOWN]")
+        assert not self.engine.encoded('utf-8').contains_tags("No brackets")
+        assert not ReplacementEngine([]).contains_tags(u"[PHONE]")
+
+    def test_unknown_tags_untouched(self):
+        content = u"[PHONE] [UNKNOWN] [phone]"
+        assert self.engine.rewrite(content, {'PHONE': u"1"}) == u"1 [UNKNOWN] [phone]"
+
+    def test_replacement_is_literal(self):
+        # Replacement data must not be treated as a regex template.
+        content = u"[PHONE]"
+        assert self.engine.rewrite(content, {'PHONE': u"\\1 $0"}) == u"\\1 $0"
+
+    def test_no_tags(self):
+        engine = ReplacementEngine([])
+        assert engine.rewrite(u"[PHONE]", {}) == u"[PHONE]"
+
+    def test_encoded_engine(self):
+        engine = self.engine.encoded('utf-8')
+        assert self.engine.encoded('utf-8') is engine
+        replacements = engine.encode_replacements({'PHONE': u"\xa3 0800"})
+        content = u"\u2603 [PHONE] [EMAIL]".encode('utf-8')
+        rewritten = engine.rewrite(content, replacements)
+        assert isinstance(rewritten, str)
+        assert rewritten == u"\u2603 \xa3 0800 [EMAIL]".encode('utf-8')
+
+    def test_encoded_engine_unrepresentable_replacement(self):
+        engine = self.engine.encoded('latin-1')
+        replacements = engine.encode_replacements({'PHONE': u"\u2603"})
+        assert engine.rewrite("[PHONE]", replacements) == "&#9731;"
+
+    def test_byte_safe_charsets(self):
+        assert is_byte_safe('UTF-8')
+        assert is_byte_safe('latin-1')
+        assert is_byte_safe('windows-1252')
+        assert not is_byte_safe('utf-16')
+        assert not is_byte_safe('shift_jis')
+        assert not is_byte_safe('no-such-charset')
+
+    def test_stream_matches_tags_split_over_chunks(self):
+        content = u"Call [PHONE] or mail [EMAIL] [PHONE]"
+        replacements = {'PHONE': u"0800 HOST", 'EMAIL': u"me@example.com"}
+        expected = self.engine.rewrite(content, replacements)
+        # Every possible chunk size, including splits mid tag.
+        for size in range(1, len(content) + 1):
+            chunks = [content[i:i + size] for i in range(0, len(content), size)]
+            output = list(self.engine.rewrite_stream(iter(chunks), replacements))
+            assert u"".join(output) == expected, size
+
+    def test_stream_holds_back_only_a_small_tail(self):
+        chunks = [u"x" * 1000, u"[PHO", u"NE]" + u"y" * 1000]
+        output = list(self.engine.rewrite_stream(iter(chunks), {'PHONE': u"1"}))
+        assert output[0] == u"x" * 1000
+        assert u"".join(output) == u"x" * 1000 + u"1" + u"y" * 1000
+
+
+class GenerationTest(BaseTestCase):
+
+    def test_bumped_by_changes(self):
+        before = generation.current_generation()
+        self.tag_phone.default = "0800 CHANGED"
+        self.tag_phone.save()
+        after_tag = generation.current_generation()
+        assert after_tag != before
+        self.data_host.delete()
+        assert generation.current_generation() != after_tag
+
+    def test_bumped_again_once_committed(self):
+        before = generation.current_generation()
+        @transaction.commit_manually
+        def save():
+            self.tag_phone.default = "0800 CHANGED"
+            self.tag_phone.save()
+            # Other processes may rebuild from the old row until the commit.
+            during = generation.current_generation()
+            transaction.commit()
+            return during
+        during = save()
+        assert during != before
+        request_finished.send(sender=self.__class__)
+        after = generation.current_generation()
+        assert after != during
+        # Only the once.
+        request_finished.send(sender=self.__class__)
+        assert generation.current_generation() == after
+
+    def test_ruleset_rebuilt_on_change(self):
+        ruleset = get_ruleset()
+        assert get_ruleset() is ruleset
+        assert ruleset.defaults == {'PHONE': "0800 DEFAULT"}
+        ReplacementTag.objects.create(tag="EMAIL", default="info@example.com")
+        new_ruleset = get_ruleset()
+        assert new_ruleset is not ruleset
+        assert new_ruleset.defaults['EMAIL'] == "info@example.com"
+
+    def test_change_in_another_process(self):
+        ruleset = get_ruleset()
+        # Another process bumps the shared generation; once we next
+        # check the shared cache we rebuild.
+        cache.incr(GENERATION_KEY)
+        generation._last_seen = (None, 0)
+        assert get_ruleset() is not ruleset
+
+
+class MiddlewareTest(BaseTestCase):
+
+    def setUp(self):
+        super(MiddlewareTest, self).setUp()
+        self.hostname_test = HostnameTestModel.objects.create(hostname="www.example.com")
+        self.hostname_test.replacements.add(self.data_host)
+        self.middleware = ContextualMiddleware()
+
+    def get_request(self, session=None, **environ):
+        request = self.req_factory.request(**environ)
+        request.session = session if session is not None else {}
+        return request
+
+    def render(self, request, content="Call [PHONE] now"):
+        self.middleware.process_view(request, None, (), {})
+        response = HttpResponse(content)
+        return self.middleware.process_response(request, response).content
+
+    def test_match_replaces_tags(self):
+        assert self.render(self.get_request()) == "Call 0800 HOST now"
+
+    def test_no_match_uses_defaults(self):
+        request = self.get_request(HTTP_HOST="www.nomatch.com")
+        assert self.render(request) == "Call 0800 DEFAULT now"
+
+    def test_session_holds_token(self):
+        request = self.get_request()
+        self.render(request)
+        token = request.session[SESSION_KEY]
+        assert isinstance(token, basestring)
+        assert token == "hostnametestmodel:%s" % self.hostname_test.pk
+
+    def test_session_hit_issues_no_queries(self):
+        session = {}
+        self.render(self.get_request(session=session))
+        # A different host would not match, but the session wins.
+        request = self.get_request(session=session, HTTP_HOST="www.nomatch.com")
+        content, queries = self.count_queries(self.render, request)
+        assert content == "Call 0800 HOST now"
+        assert queries == 0
+
+    def test_deleted_rule_falls_back_to_defaults(self):
+        session = {}
+        self.render(self.get_request(session=session))
+        self.hostname_test.delete()
+        request = self.get_request(session=session)
+        assert self.render(request) == "Call 0800 DEFAULT now"
+
+    def test_rewritten_headers(self):
+        request = self.get_request()
+        self.middleware.process_view(request, None, (), {})
+        response = HttpResponse("Call [PHONE] now")
+        response['Content-Length'] = "16"
+        response['ETag'] = '"upstream"'
+        response = self.middleware.process_response(request, response)
+        assert response['Content-Length'] == str(len("Call 0800 HOST now"))
+        etag = response['ETag']
+        assert etag.startswith('"') and etag != '"upstream"'
+        # Different for another variant, the same for the same one.
+        other = self.get_request(HTTP_HOST="www.nomatch.com")
+        self.middleware.process_view(other, None, (), {})
+        response = HttpResponse("Call [PHONE] now")
+        response['ETag'] = '"upstream"'
+        assert self.middleware.process_response(other, response)['ETag'] != etag
+        response = HttpResponse("Call [PHONE] now")
+        response['ETag'] = 'W/"upstream"'
+        weak = self.middleware.process_response(request, response)['ETag']
+        assert weak.startswith('W/"')
+
+    def test_conditional_get(self):
+        def get(**environ):
+            request = self.get_request(**environ)
+            self.middleware.process_view(request, None, (), {})
+            response = HttpResponse("Call [PHONE] now")
+            response['ETag'] = '"upstream"'
+            response['Cache-Control'] = "max-age=60"
+            return self.middleware.process_response(request, response)
+        etag = get()['ETag']
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert response.content == ""
+        assert response['ETag'] == etag
+        assert response['Cache-Control'] == "max-age=60"
+        assert get(HTTP_IF_NONE_MATCH='"upstream"').status_code == 200
+        assert get(HTTP_IF_NONE_MATCH=etag, HTTP_HOST="www.nomatch.com").status_code == 200
+        assert get(HTTP_IF_NONE_MATCH=etag, REQUEST_METHOD='POST').status_code == 200
+
+    def test_tagless_response_untouched(self):
+        request = self.get_request()
+        self.middleware.process_view(request, None, (), {})
+        response = HttpResponse("No tags [here] at all")
+        response['ETag'] = '"upstream"'
+        response = self.middleware.process_response(request, response)
+        assert response.content == "No tags [here] at all"
+        assert response['ETag'] == '"upstream"'
+
+    def test_tagless_views_learned(self):
+        self.middleware.tagless_threshold = 2
+        def view(request):
+            return HttpResponse()
+        def render(content, **view_kwargs):
+            request = self.get_request()
+            self.middleware.process_view(request, view, (), view_kwargs)
+            return self.middleware.process_response(request, HttpResponse(content)).content
+        assert render("Call [PHONE]") == "Call 0800 HOST"
+        render("No tags")
+        render("No tags")
+        # Learned; no longer scanned.
+        assert render("Call [PHONE]") == "Call [PHONE]"
+        # Other pages of the same (e.g. generic) view are counted apart.
+        render("No tags", template="about.html")
+        render("No tags", template="terms.html")
+        assert render("Call [PHONE]", template="contact.html") == "Call 0800 HOST"
+        # Until the rules change.
+        generation.bump_generation()
+        assert render("Call [PHONE]") == "Call 0800 HOST"
+
+    def test_variant_cookie(self):
+        self.middleware.variant_cookie = "variant"
+        def get(content="Call [PHONE] now", **environ):
+            request = self.get_request(**environ)
+            self.middleware.process_view(request, None, (), {})
+            return self.middleware.process_response(request, HttpResponse(content))
+        response = get()
+        key = response.cookies['variant'].value
+        assert len(key) == 16
+        # Wide enough for large rule tables not to share keys.
+        keys = set([variant_key("querystringtestmodel:%d" % pk) for pk in range(50000)])
+        assert len(keys) == 50000
+        assert get_ruleset().keyed_variant(key).key == key
+        assert response['X-Contextual-Variant'] == key
+        assert 'X-Contextual-Variant' in response['Vary']
+        # Stable for the variant, not set again once the visitor has it.
+        response = get(HTTP_COOKIE="variant=%s" % key)
+        assert response['X-Contextual-Variant'] == key
+        assert 'variant' not in response.cookies
+        response = get(HTTP_HOST="www.nomatch.com")
+        assert response.cookies['variant'].value == "default"
+        # Pages without tags still hand out the cookie, but don't vary.
+        response = get("No tags")
+        assert response.cookies['variant'].value == key
+        assert not response.has_header('Vary')
+
+    def test_variant_cookie_leaves_session(self):
+        # Through the real session middleware, which says Vary: Cookie
+        # of any response whose request's session was read.
+        self.middleware.variant_cookie = "variant"
+        sessions = SessionMiddleware()
+        def get(**environ):
+            request = self.req_factory.request(**environ)
+            sessions.process_request(request)
+            self.middleware.process_view(request, None, (), {})
+            response = self.middleware.process_response(request,
+                                                        HttpResponse("Call [PHONE] now"))
+            return sessions.process_response(request, response)
+        response = get()
+        assert response.content == "Call 0800 HOST now"
+        assert response['Vary'] == "X-Contextual-Variant"
+        key = response.cookies['variant'].value
+        # The cookie alone keeps the match.
+        response = get(HTTP_HOST="www.nomatch.com", HTTP_COOKIE="variant=%s" % key)
+        assert response.content == "Call 0800 HOST now"
+        assert response['Vary'] == "X-Contextual-Variant"
+        # Until its rule is gone.
+        self.hostname_test.delete()
+        response = get(HTTP_HOST="www.nomatch.com", HTTP_COOKIE="variant=%s" % key)
+        assert response.content == "Call 0800 DEFAULT now"
+        assert response.cookies['variant'].value == "default"
+
+    def test_decisions_remembered(self):
+        stats = MemoryStats()
+        set_stats(stats)
+        try:
+            for host in ("www.example.com", "www.example.com", "www.nomatch.com"):
+                request = self.get_request(HTTP_HOST=host, HTTP_USER_AGENT=host)
+                self.render(request)
+            assert request.session == {}
+            assert stats.counters['decision_cache.hits'] == 1
+            assert stats.counters['decision_cache.misses'] == 2
+            # Forgotten once the rules change.
+            self.hostname_test.delete()
+            assert self.render(self.get_request()) == "Call 0800 DEFAULT now"
+        finally:
+            set_stats(NullStats())
+
+    def test_fingerprints(self):
+        tests = [HostnameTest(), QueryStringTest({'get_key': 's'}), RefererTest()]
+        features = get_features(tests)
+        assert features == ['GET:s', 'host', 'referer_host']
+        fingerprint = lambda **environ: request_fingerprint(
+                self.req_factory.request(**environ), features)
+        assert fingerprint(QUERY_STRING="s=1&t=1", HTTP_REFERER="http://a.com/x") == \
+               fingerprint(QUERY_STRING="s=1&t=2", HTTP_REFERER="http://a.com/y")
+        assert fingerprint(QUERY_STRING="s=1") != fingerprint(QUERY_STRING="s=2")
+        assert fingerprint() != fingerprint(HTTP_REFERER="http://a.com/")
+        # Tests not declaring their features can't be fingerprinted.
+        class UndeclaredTest(HostnameTest):
+            features = None
+        assert get_features(tests + [UndeclaredTest()]) is None
+
+    def test_variant_shared_between_requests(self):
+        first, second = self.get_request(), self.get_request()
+        self.render(first)
+        self.render(second)
+        assert first.contextual_variant is second.contextual_variant
+        assert first.contextual_variant.replacements == {'PHONE': "0800 HOST"}
+        unmatched = self.get_request(HTTP_HOST="www.nomatch.com")
+        self.render(unmatched)
+        assert not hasattr(unmatched, 'contextual_variant')
+        assert get_ruleset().default_variant.replacements == {'PHONE': "0800 DEFAULT"}
+
+    def test_variant_merges_defaults(self):
+        tag_email = ReplacementTag.objects.create(tag="EMAIL", default="info@example.com")
+        request = self.get_request()
+        content = self.render(request, "[PHONE] [EMAIL]")
+        assert content == "0800 HOST info@example.com"
+
+    def test_streaming_response(self):
+        request = self.get_request()
+        self.middleware.process_view(request, None, (), {})
+        chunks = iter(["Call [PH", "ONE] now, \xc2", "\xa3 [PHONE]"])
+        response = HttpResponse(chunks)
+        response = self.middleware.process_response(request, response)
+        assert "".join(response) == "Call 0800 HOST now, \xc2\xa3 0800 HOST"
+
+    def test_response_charset_respected(self):
+        self.data_host.data = u"\xa3 0800"
+        self.data_host.save()
+        request = self.get_request()
+        self.middleware.process_view(request, None, (), {})
+        response = HttpResponse(u"\xe9 [PHONE]".encode('latin-1'),
+                                content_type="text/html; charset=ISO-8859-1")
+        response = self.middleware.process_response(request, response)
+        assert response.content == u"\xe9 \xa3 0800".encode('latin-1')
+
+    def test_non_byte_safe_charset(self):
+        request = self.get_request()
+        self.middleware.process_view(request, None, (), {})
+        response = HttpResponse(u"[PHONE]".encode('utf-16'),
+                                content_type="text/html; charset=utf-16")
+        response = self.middleware.process_response(request, response)
+        assert response.content.decode('utf-16') == u"0800 HOST"
+
+    def test_non_byte_safe_streaming_response(self):
+        request = self.get_request()
+        self.middleware.process_view(request, None, (), {})
+        content = u"\u2603 [PHONE]".encode('utf-16')
+        response = HttpResponse(iter([content[:5], content[5:]]),
+                                content_type="text/html; charset=utf-16")
+        response = self.middleware.process_response(request, response)
+        assert "".join(response).decode('utf-16') == u"\u2603 0800 HOST"
+
+    def test_excluded_prefixes(self):
+        old_media_url = settings.MEDIA_URL
+        settings.MEDIA_URL = "/media/"
+        try:
+            middleware = ContextualMiddleware()
+            request = self.get_request(PATH_INFO="/media/logo.png")
+            assert middleware.is_excludable(request)
+            assert middleware.process_view(request, None, (), {}) is None
+            assert not hasattr(request, 'contextual_variant')
+            response = middleware.process_response(request, HttpResponse("[PHONE]"))
+            assert response.content == "[PHONE]"
+            request = self.get_request(PATH_INFO="/mediafile/")
+            assert not middleware.is_excludable(request)
+        finally:
+            settings.MEDIA_URL = old_media_url
+
+    def test_exclusion_memoized_on_request(self):
+        request = self.get_request(PATH_INFO="/page/")
+        assert not self.middleware.is_excludable(request)
+        assert request.contextual_excluded is False
+
+    def test_legacy_session_value_ignored(self):
+        # Sessions from older versions held the matched rule itself.
+        session = {SESSION_KEY: self.hostname_test}
+        request = self.get_request(session=session)
+        assert self.render(request) == "Call 0800 HOST now"
+        assert isinstance(session[SESSION_KEY], basestring)
+
+
+class PageCacheTest(BaseTestCase):
+
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        self.hostname_test = HostnameTestModel.objects.create(hostname="www.example.com")
+        self.hostname_test.replacements.add(self.data_host)
+        self.middleware = ContextualMiddleware()
+        self.middleware.page_cache_timeout = 60
+        self.views = 0
+
+    def view(self, request):
+        self.views += 1
+        return HttpResponse("Call [PHONE] now")
+
+    def get(self, view=None, method='GET', **environ):
+        view = view or self.view
+        request = self.req_factory.request(REQUEST_METHOD=method, **environ)
+        request.session = {}
+        response = self.middleware.process_view(request, view, (), {})
+        if response is None:
+            response = view(request)
+        return self.middleware.process_response(request, response)
+
+    def test_hit_skips_view(self):
+        first = self.get(PATH_INFO="/cached/")
+        second = self.get(PATH_INFO="/cached/")
+        assert first.content == second.content == "Call 0800 HOST now"
+        assert second['Content-Type'] == first['Content-Type']
+        assert self.views == 1
+
+    def test_keyed_by_variant_and_url(self):
+        self.get(PATH_INFO="/keyed/")
+        assert self.get(PATH_INFO="/keyed/", HTTP_HOST="www.nomatch.com").content == \
+                "Call 0800 DEFAULT now"
+        self.get(PATH_INFO="/keyed/", QUERY_STRING="page=2")
+        assert self.views == 3
+
+    def test_rule_change_invalidates(self):
+        self.get(PATH_INFO="/changed/")
+        self.data_host.data = "0800 CHANGED"
+        self.data_host.save()
+        assert self.get(PATH_INFO="/changed/").content == "Call 0800 CHANGED now"
+        assert self.views == 2
+
+    def test_conditional_get_from_cache(self):
+        def view(request):
+            response = self.view(request)
+            response['ETag'] = '"upstream"'
+            return response
+        etag = self.get(view, PATH_INFO="/etag/")['ETag']
+        response = self.get(view, PATH_INFO="/etag/", HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert self.views == 1
+
+    def test_private_and_exempt_not_cached(self):
+        def private_view(request):
+            response = self.view(request)
+            response['Cache-Control'] = "max-age=60, private"
+            return response
+        self.get(private_view, PATH_INFO="/private/")
+        self.get(private_view, PATH_INFO="/private/")
+        exempt_view = page_cache_exempt(self.view)
+        self.get(exempt_view, PATH_INFO="/exempt/")
+        self.get(exempt_view, PATH_INFO="/exempt/")
+        self.get(method='POST', PATH_INFO="/posted/")
+        self.get(method='POST', PATH_INFO="/posted/")
+        assert self.views == 6
+
+    def test_varying_not_cached(self):
+        def view(request, vary):
+            response = self.view(request)
+            patch_vary_headers(response, vary)
+            return response
+        localised_view = lambda request: view(request, ('Accept-Language',))
+        self.get(localised_view, PATH_INFO="/localised/", HTTP_ACCEPT_LANGUAGE="de")
+        self.get(localised_view, PATH_INFO="/localised/", HTTP_ACCEPT_LANGUAGE="fr")
+        assert self.views == 2
+        user_view = lambda request: view(request, ('Cookie',))
+        self.get(user_view, PATH_INFO="/user/", HTTP_COOKIE="sessionid=alice")
+        self.get(user_view, PATH_INFO="/user/", HTTP_COOKIE="sessionid=bob")
+        assert self.views == 4
+        # Those varying per variant only are.
+        variant_view = lambda request: view(request, ('X-Contextual-Variant',))
+        self.get(variant_view, PATH_INFO="/variant/")
+        self.get(variant_view, PATH_INFO="/variant/")
+        assert self.views == 5
+
+    def test_disabled_by_default(self):
+        self.middleware = ContextualMiddleware()
+        self.get(PATH_INFO="/disabled/")
+        self.get(PATH_INFO="/disabled/")
+        assert self.views == 2
+
+
+class TemplateTagTest(BaseTestCase):
+
+    def setUp(self):
+        super(TemplateTagTest, self).setUp()
+        self.hostname_test = HostnameTestModel.objects.create(hostname="www.example.com")
+        self.hostname_test.replacements.add(self.data_host)
+        self.middleware = ContextualMiddleware()
+        self.template = Template('{% load contextual_tags %}'
+                                 'Call {% contextual "PHONE" %} or [PHONE]')
+
+    def get_request(self, **environ):
+        request = self.req_factory.request(**environ)
+        request.session = {}
+        self.middleware.process_view(request, None, (), {})
+        return request
+
+    def test_tag_uses_matched_variant(self):
+        request = self.get_request()
+        content = self.template.render(Context(contextual_processor(request)))
+        assert content == "Call 0800 HOST or [PHONE]"
+        # The request alone will do as well.
+        request = self.get_request(HTTP_HOST="www.nomatch.com")
+        content = self.template.render(Context({'request': request}))
+        assert content == "Call 0800 DEFAULT or [PHONE]"
+
+    def test_unknown_tag_left_alone(self):
+        template = Template('{% load contextual_tags %}{% contextual tag %}')
+        context = Context(contextual_processor(self.get_request()))
+        context['tag'] = "MISSING"
+        assert template.render(context) == "[MISSING]"
+        self.assertRaises(TemplateSyntaxError, Template,
+                          '{% load contextual_tags %}{% contextual %}')
+
+    def test_rendered_response_not_scanned(self):
+        def view(request):
+            content = self.template.render(Context(contextual_processor(request)))
+            return HttpResponse(content)
+        request = self.get_request()
+        response = replaced_when_rendered(view)(request)
+        response = self.middleware.process_response(request, response)
+        assert response.content == "Call 0800 HOST or [PHONE]"
+        # Without the decorator the fallback scan catches the rest.
+        response = self.middleware.process_response(request, view(request))
+        assert response.content == "Call 0800 HOST or 0800 HOST"
+
+
+class RuleFilesTest(BaseTestCase):
+
+    def import_rules(self, model, content, format='csv', batch_size=500):
+        importer = RuleImporter(model, batch_size)
+        importer.run(read_rules(StringIO(content), format))
+        return importer
+
+    def test_import_csv(self):
+        existing = QueryStringTestModel.objects.create(value="existing")
+        generation_before = generation.current_generation()
+        importer, queries = self.count_queries(self.import_rules, QueryStringTestModel,
+                "value,replacements\n"
+                "existing,PHONE=0800 HOST\n"
+                "campaign1,PHONE=0800 GOOGLE\n"
+                "campaign2,PHONE=0800 NEW|PHONE=0800 HOST\n"
+                "campaign3,\n", batch_size=2)
+        assert (importer.created, importer.updated) == (3, 0)
+        assert QueryStringTestModel.objects.count() == 4
+        assert list(existing.replacements.all()) == [self.data_host]
+        rule = QueryStringTestModel.objects.get(value="campaign2")
+        assert sorted(rule.replacements.values_list('data', flat=True)) == \
+                ["0800 HOST", "0800 NEW"]
+        assert QueryStringTestModel.objects.get(value="campaign3").replacements.count() == 0
+        # A handful of queries per batch rather than per rule.
+        assert queries < 20
+        # The new data was created but the generation only moved on once.
+        assert ReplacementData.objects.get(data="0800 NEW").tag == self.tag_phone
+        assert generation.current_generation() == generation_before + 1
+
+    def test_import_jsonl(self):
+        BrandedSearchRefererTestModel.objects.create(search_engine="google", branded=False)
+        importer = self.import_rules(BrandedSearchRefererTestModel,
+                '{"search_engine": "google", "branded": false, "replacements": []}\n'
+                '\n'
+                '{"search_engine": "google", "branded": true, '
+                '"replacements": ["PHONE=0800 GOOGLE"]}\n', format='jsonl')
+        assert (importer.created, importer.updated) == (1, 0)
+        rule = BrandedSearchRefererTestModel.objects.get(search_engine="google", branded=True)
+        assert list(rule.replacements.all()) == [self.data_google]
+        self.assertRaises(ValueError, self.import_rules, QueryStringTestModel,
+                          "value,replacements\nbad,MISSING=tag\n")
+        self.assertRaises(ValueError, self.import_rules, QueryStringTestModel,
+                          "replacements\nPHONE=0800 HOST\n")
+        self.assertRaises(ValueError, self.import_rules, BrandedSearchRefererTestModel,
+                          "search_engine,branded\ngoogle,false\n")
+
+    def test_failed_import_bumps_generation(self):
+        generation_before = generation.current_generation()
+        self.assertRaises(ValueError, self.import_rules, QueryStringTestModel,
+                          "value,replacements\n"
+                          "campaign1,PHONE=0800 GOOGLE\n"
+                          "campaign2,MISSING=tag\n", batch_size=1)
+        # The first batch was committed, so must be seen.
+        assert QueryStringTestModel.objects.filter(value="campaign1").exists()
+        assert generation.current_generation() == generation_before + 1
+
+    def test_export_round_trip(self):
+        first = RefererTestModel.objects.create(domain="google.")
+        first.replacements.add(self.data_google, self.data_host)
+        RefererTestModel.objects.create(domain="example.com")
+        for format in ('csv', 'jsonl'):
+            output = StringIO()
+            write_rules(output, format, RefererTestModel,
+                        export_rules(RefererTestModel, batch_size=1))
+            RefererTestModel.objects.all().delete()
+            importer = self.import_rules(RefererTestModel, output.getvalue(), format)
+            assert importer.created == 2
+            assert sorted(export_rules(RefererTestModel)) == sorted([
+                {'domain': u"google.",
+                 'replacements': [u"PHONE=0800 GOOGLE", u"PHONE=0800 HOST"]},
+                {'domain': u"example.com", 'replacements': []}])
+
+    def test_commands(self):
+        HostnameTestModel.objects.create(hostname="www.example.com").replacements.add(
+                self.data_host)
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        try:
+            call_command('exportrules', 'hostnametestmodel', path)
+            HostnameTestModel.objects.all().delete()
+            call_command('importrules', 'hostnametestmodel', path, verbosity=0)
+        finally:
+            os.remove(path)
+        rule = HostnameTestModel.objects.get()
+        assert rule.hostname == "www.example.com"
+        assert list(rule.replacements.all()) == [self.data_host]
+        # Bad values are reported, not raised.
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, "search_engine,branded\ngoogle,false\n")
+        os.close(handle)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(SystemExit, call_command, 'importrules',
+                              'brandedsearchreferertestmodel', path, verbosity=0)
+            assert "invalid branded field" in sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+            os.remove(path)
+
+
+class MappedTest(BaseTestCase):
+
+    def setUp(self):
+        super(MappedTest, self).setUp()
+        self.hostname_test = HostnameTestModel.objects.create(hostname="www.Example.com")
+        self.hostname_test.replacements.add(self.data_host)
+        self.directory = tempfile.mkdtemp()
+        self.old_directory = mapped.SNAPSHOT_DIR
+        mapped.SNAPSHOT_DIR = self.directory
+
+    def tearDown(self):
+        mapped.SNAPSHOT_DIR = self.old_directory
+        mapped._tables.clear()
+        shutil.rmtree(self.directory)
+
+    def test_table(self):
+        path = os.path.join(self.directory, "test.table")
+        items = [("key%d" % i, "value%d" % i) for i in range(100)]
+        write_table(path, items + [("key5", "duplicate"), ("", "empty")])
+        table = MappedTable(path)
+        assert len(table) == 101
+        for key, value in items:
+            assert table.get(key) == value
+        assert table.get("") == "empty"
+        assert table.get("key100") is None
+        assert table.get("a", "missing") == "missing"
+        write_table(path, [])
+        assert MappedTable(path).get("key1") is None
+
+    def test_lookup_from_table(self):
+        test = HostnameTest()
+        request = self.req_factory.request()
+        test.test(request)
+        assert os.listdir(self.directory)
+        match, queries = self.count_queries(test.test, request)
+        assert queries == 0
+        assert match == self.hostname_test
+        assert match.hostname == "www.Example.com"
+        assert get_ruleset().variant(rule_token(match)).replacements == {'PHONE': "0800 HOST"}
+        assert test.test(self.req_factory.request(HTTP_HOST="www.nomatch.com")) is None
+
+    def test_tables_rebuilt_per_generation(self):
+        test = HostnameTest()
+        test.test(self.req_factory.request())
+        HostnameTestModel.objects.create(hostname="www.new.com")
+        assert test.test(self.req_factory.request(HTTP_HOST="www.new.com"))
+        # Only the latest generation's table is kept.
+        assert len([name for name in os.listdir(self.directory)
+                    if name.startswith("hostname-")]) == 1
+
+    def test_variant_from_table(self):
+        token = "hostnametestmodel:%s" % self.hostname_test.pk
+        variant = get_ruleset().variant(token)
+        assert variant.replacements == {'PHONE': "0800 HOST"}
+        assert "hostnametestmodel-replacements-%s.table" % get_ruleset().generation in \
+                os.listdir(self.directory)
+
+
+class ResolverTest(BaseTestCase):
+
+    def setUp(self):
+        super(ResolverTest, self).setUp()
+        self.hostname_test = HostnameTestModel.objects.create(hostname="www.example.com")
+        self.querystring_test = QueryStringTestModel.objects.create(value="campaign")
+        self.referer_test = RefererTestModel.objects.create(domain="google.")
+        self.branded_test = BrandedSearchRefererTestModel.objects.create(
+                search_engine="google", branded=True)
+        config = {'use_snapshot': False}
+        self.tests = [
+            BrandedSearchRefererTest({'brand_terms': ["brand"], 'use_snapshot': False}),
+            RefererTest(config),
+            QueryStringTest({'get_key': 's', 'use_snapshot': False}),
+            HostnameTest(config),
+        ]
+
+    def test_priority_order(self):
+        request = self.req_factory.request(
+                QUERY_STRING="s=campaign",
+                HTTP_REFERER="http://www.google.co.uk/search?q=brand")
+        assert resolve(self.tests, request) == \
+                "brandedsearchreferertestmodel:%s" % self.branded_test.pk
+        request = self.req_factory.request(
+                QUERY_STRING="s=campaign",
+                HTTP_REFERER="http://www.google.co.uk/search?q=other")
+        assert resolve(self.tests, request) == \
+                "referertestmodel:%s" % self.referer_test.pk
+        request = self.req_factory.request(QUERY_STRING="s=CAMPAIGN")
+        assert resolve(self.tests, request) == \
+                "querystringtestmodel:%s" % self.querystring_test.pk
+        request = self.req_factory.request()
+        assert resolve(self.tests, request) == \
+                "hostnametestmodel:%s" % self.hostname_test.pk
+        request = self.req_factory.request(HTTP_HOST="www.nomatch.com")
+        assert resolve(self.tests, request) is None
+
+    def test_single_round_trip(self):
+        request = self.req_factory.request(
+                HTTP_HOST="www.nomatch.com", QUERY_STRING="s=nomatch",
+                HTTP_REFERER="http://www.bing.com/search?q=other")
+        token, queries = self.count_queries(resolve, self.tests, request)
+        assert token is None
+        assert queries == 1
+
+    def test_snapshot_tests_run_first(self):
+        self.tests[0] = BrandedSearchRefererTest({'brand_terms': ["brand"]})
+        # Warm the snapshot.
+        self.tests[0].test(self.req_factory.request())
+        request = self.req_factory.request(
+                HTTP_REFERER="http://www.google.com/search?q=brand")
+        token, queries = self.count_queries(resolve, self.tests, request)
+        assert token == "brandedsearchreferertestmodel:%s" % self.branded_test.pk
+        assert queries == 0
+
+    def test_query_tests_match_like_snapshots(self):
+        referer_test = RefererTest({'use_snapshot': False})
+        request = self.req_factory.request(HTTP_REFERER="http://google.fr/")
+        assert referer_test.test(request) == self.referer_test
+        hostname_test = HostnameTest({'use_snapshot': False})
+        assert hostname_test.test(self.req_factory.request()) == self.hostname_test
+
+    def test_lookups_remembered(self):
+        miss = self.req_factory.request(HTTP_HOST="www.nomatch.com",
+                                        HTTP_REFERER="http://www.bing.com/")
+        hit = self.req_factory.request()
+        resolve(self.tests, miss)
+        resolve(self.tests, hit)
+        token, queries = self.count_queries(resolve, self.tests, miss)
+        assert token is None
+        assert queries == 0
+        token, queries = self.count_queries(resolve, self.tests, hit)
+        assert token == "hostnametestmodel:%s" % self.hostname_test.pk
+        assert queries == 0
+        # Remembered misses are forgotten once the rules change.
+        HostnameTestModel.objects.create(hostname="www.nomatch.com")
+        token, queries = self.count_queries(resolve, self.tests, miss)
+        assert token is not None
+        assert queries == 1
+
+    def test_test_remembers_misses(self):
+        hostname_test = HostnameTest({'use_snapshot': False})
+        request = self.req_factory.request(HTTP_HOST="www.nomatch.com")
+        hostname_test.test(request)
+        match, queries = self.count_queries(hostname_test.test, request)
+        assert match is None
+        assert queries == 0
+        hostname_test = HostnameTest({'use_snapshot': False, 'lookup_cache_size': 0})
+        hostname_test.test(request)
+        match, queries = self.count_queries(hostname_test.test, request)
+        assert queries == 1
+
+    def test_test_remembers_hits(self):
+        hostname_test = HostnameTest({'use_snapshot': False})
+        request = self.req_factory.request(HTTP_HOST="www.example.com")
+        first = hostname_test.test(request)
+        assert hostname_test.get_lookup_cache().get("www.example.com") == rule_token(first)
+        match, queries = self.count_queries(hostname_test.test, request)
+        assert match == first
+        assert queries == 0
+        # Shared with the resolver, which returns the token without a query.
+        token, queries = self.count_queries(resolve, [hostname_test], request)
+        assert token == rule_token(first)
+        assert queries == 0
+        # Matches remembered by the resolver are fetched by pk, once.
+        hostname_test = HostnameTest({'use_snapshot': False})
+        resolve([hostname_test], request)
+        match, queries = self.count_queries(hostname_test.test, request)
+        assert match == first
+        assert queries == 1
+        match, queries = self.count_queries(hostname_test.test, request)
+        assert match == first
+        assert queries == 0
+
+
+class LRUCacheTest(TestCase):
+
+    def test_least_recently_used_dropped(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        assert lru.get('a') == 1
+        lru.set('c', 3)
+        assert 'b' not in lru
+        assert lru.get('a') == 1 and lru.get('c') == 3
+        assert len(lru) == 2
+        lru.set('a', None)
+        assert lru.get('a', NotImplemented) is None
+        assert lru.get('b', NotImplemented) is NotImplemented
+        lru.clear()
+        assert len(lru) == 0
+
+
+class StatsTest(BaseTestCase):
+
+    def setUp(self):
+        super(StatsTest, self).setUp()
+        self.hostname_test = HostnameTestModel.objects.create(hostname="www.example.com")
+        self.stats = MemoryStats()
+        set_stats(self.stats)
+
+    def tearDown(self):
+        set_stats(NullStats())
+
+    def test_disabled_by_default(self):
+        set_stats(None)
+        assert not get_stats().enabled
+
+    def test_test_stats(self):
+        test = HostnameTest()
+        test.test(self.req_factory.request())
+        test.test(self.req_factory.request(HTTP_HOST="www.nomatch.com"))
+        assert self.stats.counters['test.HostnameTest.calls'] == 2
+        assert self.stats.counters['test.HostnameTest.matches'] == 1
+        timing = self.stats.timings['test.HostnameTest.time']
+        assert timing['count'] == 2
+        assert sum(timing['histogram']) == 2
+
+    def test_query_counts_when_debugging(self):
+        test = HostnameTest({'use_snapshot': False})
+        self.count_queries(test.test, self.req_factory.request())
+        assert self.stats.counters['test.HostnameTest.queries'] == 1
+
+    def test_middleware_stats(self):
+        middleware = ContextualMiddleware()
+        session = {}
+        for i in range(3):
+            request = self.req_factory.request()
+            request.session = session
+            middleware.process_view(request, None, (), {})
+            middleware.process_response(request, HttpResponse("[PHONE]"))
+        assert self.stats.counters['session.misses'] == 1
+        assert self.stats.counters['session.hits'] == 2
+        assert self.stats.counters['response.rewrites'] == 3
+        assert self.stats.timings['response.rewrite.time']['count'] == 3
+
+    def test_statsd_lines(self):
+        sent = []
+        class TestStatsdStats(StatsdStats):
+            def send(self, data):
+                sent.append(data)
+        stats = TestStatsdStats()
+        stats.incr("session.hits")
+        stats.timing("test.HostnameTest.time", 0.0000427)
+        stats.timing("resolver.batch.time", 1.5)
+        assert sent == ["contextual.session.hits:1|c",
+                        "contextual.test.HostnameTest.time:0.043|ms",
+                        "contextual.resolver.batch.time:1500.000|ms"]
+
 
 class HostnameRequestTest(BaseTestCase):
 
@@ -125,6 +1086,41 @@ class HostnameRequestTest(BaseTestCase):
         match = self.test.test(request)
         assert match == self.hostname_test3
 
+    def test_snapshot_lookups_issue_no_queries(self):
+        request = self.req_factory.request(HTTP_HOST="WWW.Example.com")
+        # The first lookup builds the snapshot, later ones use it.
+        self.test.test(request)
+        match, queries = self.count_queries(self.test.test, request)
+        assert match == self.hostname_test1
+        assert queries == 0
+        assert get_ruleset().variant(rule_token(match)).replacements == {'PHONE': "0800 HOST"}
+
+    def test_snapshot_rebuilt_on_rule_change(self):
+        request = self.req_factory.request(HTTP_HOST="www.new.com")
+        assert self.test.test(request) is None
+        new_test = HostnameTestModel.objects.create(hostname="www.new.com")
+        assert self.test.test(request) == new_test
+        new_test.replacements.add(self.data_google)
+        token = rule_token(self.test.test(request))
+        assert get_ruleset().variant(token).replacements == {'PHONE': "0800 GOOGLE"}
+        self.data_google.active = False
+        self.data_google.save()
+        assert get_ruleset().variant(token).replacements == {'PHONE': "0800 DEFAULT"}
+
+    def test_replacements_queried_per_rule_without_snapshots(self):
+        ruleset = get_ruleset()
+        ruleset.snapshots = {HostnameTestModel: False}
+        token = rule_token(self.hostname_test3)
+        variant, queries = self.count_queries(ruleset.variant, token)
+        assert variant.replacements == {'PHONE': "0800 ANOTHER"}
+        assert queries == 1
+        # None of the other rules' replacements were loaded.
+        assert ruleset.maps == {}
+        ruleset.snapshots = {HostnameTestModel: True}
+        assert ruleset.variant(rule_token(self.hostname_test1)).replacements == \
+                {'PHONE': "0800 HOST"}
+        assert len(ruleset.maps['hostnametestmodel']) == 3
+
 class PathRequestTest(BaseTestCase):
 
     def setUp(self):
@@ -152,6 +1148,54 @@ class PathRequestTest(BaseTestCase):
         match = self.test.test(request)
         assert match is None
 
+    def test_prefix_and_regex_rules(self):
+        offers = PathTestModel.objects.create(path='/offers/', kind='prefix')
+        summer = PathTestModel.objects.create(path='/offers/summer/*', kind='prefix')
+        landing = PathTestModel.objects.create(path=r'^/lp/(?P<slug>[^/]+)/$', kind='regex')
+        PathTestModel.objects.create(path='^/(broken/$', kind='regex')
+        cases = [
+            ('/offers/', offers),
+            ('/OFFERS/winter/', offers),
+            ('/offers/summer/beach/', summer),
+            ('/offersale/', None),
+            ('/lp/spring/', landing),
+            ('/lp/spring/more/', None),
+            ('/parent/', self.path_test2),
+        ]
+        for test in (PathTest(), PathTest({'use_snapshot': False})):
+            for path, rule in cases:
+                assert test.test(self.req_factory.request(PATH_INFO=path)) == rule, path
+        request = self.req_factory.request(PATH_INFO='/lp/spring/')
+        assert resolve([PathTest({'use_snapshot': False})], request) == \
+                "pathtestmodel:%s" % landing.pk
+
+    def test_regex_rules_with_backreferences(self):
+        first = PathTestModel.objects.create(path=r'^/(a)/$', kind='regex')
+        repeated = PathTestModel.objects.create(path=r'^/(b)/\1/$', kind='regex')
+        last = PathTestModel.objects.create(path=r'^/(b|c)/', kind='regex')
+        cases = [
+            ('/a/', first),
+            ('/b/b/', repeated),
+            # Still the first to match wins.
+            ('/b/c/', last),
+            ('/c/', last),
+        ]
+        for path, rule in cases:
+            assert PathTest().test(self.req_factory.request(PATH_INFO=path)) == rule, path
+
+    def test_root_prefix_matches_everything(self):
+        self.path_test1.kind = 'prefix'
+        self.path_test1.save()
+        request = self.req_factory.request(PATH_INFO='/parent/child')
+        assert self.test.test(request) == self.path_test1
+        # Exact rules still win.
+        request = self.req_factory.request(PATH_INFO='/parent/child/')
+        assert self.test.test(request) == self.path_test3
+
+    def test_invalid_regex_rejected(self):
+        rule = PathTestModel(path='^/(broken/$', kind='regex')
+        self.assertRaises(ValidationError, rule.clean)
+
 class QueryStringRequestTest(BaseTestCase):
 
     def setUp(self):
@@ -254,6 +1298,27 @@ class RefererRequestTest(BaseTestCase):
         match = self.test.test(request)
         assert match == self.referer_test2
 
+    def test_subdomain_match(self):
+        request = self.req_factory.request(HTTP_REFERER="http://mail.google.com/")
+        match = self.test.test(request)
+        assert match == self.referer_test2
+        request = self.req_factory.request(HTTP_REFERER="http://notgoogle.com/")
+        assert self.test.test(request) is None
+
+    def test_tld_agnostic_match(self):
+        all_google = RefererTestModel.objects.create(domain="google.")
+        www_google = RefererTestModel.objects.create(domain="www.google.")
+        request = self.req_factory.request(HTTP_REFERER="http://google.fr/")
+        assert self.test.test(request) == all_google
+        request = self.req_factory.request(HTTP_REFERER="http://www.google.co.uk/")
+        assert self.test.test(request) == www_google
+        # A TLD is required after the labels.
+        request = self.req_factory.request(HTTP_REFERER="http://www.google/")
+        assert self.test.test(request) is None
+        # The more specific domain rules still win.
+        request = self.req_factory.request(HTTP_REFERER="http://www.google.com/")
+        assert self.test.test(request) == self.referer_test1
+
 class BrandedSearchRefererRequestTest(BaseTestCase):
     """
     This test is designed to work with the DEFAULT_SEARCH_ENGINES
@@ -291,6 +1356,28 @@ class BrandedSearchRefererRequestTest(BaseTestCase):
         except ImproperlyConfigured:
             assert False, "Correct key in config dictionary but we're getting an error."
 
+    def test_non_engine_hostname(self):
+        # The engine names must be whole labels of the hostname.
+        referer_url = "http://www.task.com/search?q=branded"
+        request = self.req_factory.request(HTTP_REFERER=referer_url)
+        assert self.test.test(request) is None
+
+    def test_is_branded(self):
+        assert self.test.is_branded(u"my BRAND search")
+        assert not self.test.is_branded(u"my search")
+        assert not self.test.is_branded(None)
+        test = BrandedSearchRefererTest({'brand_terms': []})
+        assert not test.is_branded(u"brand")
+        # Terms referring to their own groups still match as they would alone.
+        test = BrandedSearchRefererTest({'brand_terms': ["(acme)", r"(x)\1"]})
+        assert test.is_branded(u"xx")
+        assert test.is_branded(u"acme")
+        assert not test.is_branded(u"xy")
+        # As do terms sharing a group name.
+        test = BrandedSearchRefererTest({'brand_terms': ["(?P<b>acme)", "(?P<b>foo)"]})
+        assert test.is_branded(u"foo")
+        assert not test.is_branded(u"bar")
+
     def test_no_referer(self):
         """
         Test that no referer returns No match and doesn't 500.
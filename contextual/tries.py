@@ -0,0 +1,260 @@
+"""
+Label tries used by the contextual tests to match requests against
+partial rules (such as domains or path prefixes) in memory rather
+than in the database.
+"""
+import re
+
+# A numbered backreference (\1 to \99) or conditional ((?(1)...)) that
+# isn't escaped itself. Patterns holding one mean something else once
+# combined with others, as that renumbers their groups.
+NUMBERED_REFERENCE = re.compile(r"(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\([0-9])")
+
+
+def has_numbered_references(pattern):
+    """
+    Returns True if the regular expression (a string) refers to any
+    of its groups by number, so can't be combined with others.
+    """
+    return NUMBERED_REFERENCE.search(pattern) is not None
+
+
+class Node(object):
+    """
+    A single node of a trie; its children are keyed by label.
+    """
+    __slots__ = ('children', 'value')
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+
+    def insert(self, labels, value):
+        """
+        Stores the value at the node reached by following the labels
+        from this one, creating nodes as required. The first value
+        stored at a node wins.
+        """
+        node = self
+        for label in labels:
+            node = node.children.setdefault(label, Node())
+        if node.value is None:
+            node.value = value
+
+
+class DomainTrie(object):
+    """
+    Matches hostnames against domain patterns of two forms:
+
+    'example.com' matches that domain and any subdomain of it, e.g.
+    'www.example.com'. These are held in a trie of reversed labels.
+
+    'google.' (note the trailing dot) matches those labels followed by
+    any top level domain, e.g. 'www.google.co.uk' or 'google.fr'.
+    These are held in a trie of labels in their usual order.
+
+    A lookup returns the value of the most specific match: any match of
+    the first form beats one of the second and otherwise the pattern
+    with the most labels wins.
+    """
+
+    def __init__(self, patterns=()):
+        """
+        Arguments: patterns - An iterable of (pattern, value) pairs.
+        """
+        self.suffixes = Node()
+        self.prefixes = Node()
+        for pattern, value in patterns:
+            self.add(pattern, value)
+
+    def add(self, pattern, value):
+        """
+        Adds a domain pattern, of either form, to the trie.
+        """
+        pattern = pattern.strip().lower().lstrip('.')
+        if pattern.endswith('.'):
+            labels = pattern.rstrip('.').split('.')
+            if labels != ['']:
+                self.prefixes.insert(labels, value)
+        elif pattern:
+            labels = pattern.split('.')
+            labels.reverse()
+            self.suffixes.insert(labels, value)
+
+    @staticmethod
+    def candidates(hostname):
+        """
+        Returns every pattern, of either form, which could match
+        the hostname; for looking up patterns held elsewhere.
+        """
+        labels = hostname.lower().rstrip('.').split('.')
+        patterns = ['.'.join(labels[start:]) for start in range(len(labels))]
+        for start in range(len(labels) - 1):
+            for end in range(start + 1, len(labels)):
+                patterns.append('.'.join(labels[start:end]) + '.')
+        return patterns
+
+    def lookup(self, hostname):
+        """
+        Returns the value of the most specific pattern
+        matching the hostname, else None.
+        """
+        labels = hostname.lower().rstrip('.').split('.')
+        # The longest matching suffix, walking in from the TLD.
+        match = None
+        node = self.suffixes
+        for label in reversed(labels):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.value is not None:
+                match = node.value
+        if match is not None or not self.prefixes.children:
+            return match
+        # Otherwise the longest run of labels, from any starting label,
+        # matching a TLD-agnostic pattern and leaving at least one
+        # label after it for the TLD.
+        best = 0
+        last = len(labels) - 1
+        for start in range(last):
+            node = self.prefixes
+            for end in range(start, last):
+                node = node.children.get(labels[end])
+                if node is None:
+                    break
+                if node.value is not None and end - start + 1 > best:
+                    best = end - start + 1
+                    match = node.value
+        return match
+
+
+class PathTrie(object):
+    """
+    Matches paths against path prefixes, segment by segment, so the
+    prefix '/offers/' matches '/offers/' and any path within it, e.g.
+    '/offers/summer/', but not '/offersale/'. The prefix '/' matches
+    every path. A lookup returns the value of the longest match.
+    """
+
+    def __init__(self, prefixes=()):
+        """
+        Arguments: prefixes - An iterable of (prefix, value) pairs.
+        """
+        self.root = Node()
+        for prefix, value in prefixes:
+            self.add(prefix, value)
+
+    @staticmethod
+    def segments(path):
+        return [segment for segment in path.lower().split('/') if segment]
+
+    def add(self, prefix, value):
+        """
+        Adds a path prefix to the trie. Any trailing '*' is ignored.
+        """
+        self.root.insert(self.segments(prefix.rstrip('*')), value)
+
+    def lookup(self, path):
+        """
+        Returns the value of the longest prefix
+        matching the path, else None.
+        """
+        node = self.root
+        match = node.value
+        for segment in self.segments(path):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.value is not None:
+                match = node.value
+        return match
+
+
+class PathDispatcher(object):
+    """
+    Matches paths against rules of three kinds at once: exact paths
+    (case insensitive) held in a dictionary, path prefixes held in a
+    PathTrie and regular expressions combined into as few patterns as
+    their numbered references allow.
+    An exact match wins, then the first matching regular expression
+    (in the order added) and then the longest matching prefix.
+    """
+
+    def __init__(self, rules=()):
+        """
+        Arguments: rules - An iterable of (kind, path, value) triplets,
+                       kind being one of 'exact', 'prefix' or 'regex'.
+                       Invalid regular expressions are ignored.
+        """
+        self.exact = {}
+        self.prefixes = PathTrie()
+        patterns = []
+        for kind, path, value in rules:
+            if kind == 'prefix':
+                self.prefixes.add(path, value)
+            elif kind == 'regex':
+                try:
+                    patterns.append((re.compile(path, re.IGNORECASE|re.UNICODE),
+                                     value))
+                except re.error:
+                    pass
+            else:
+                self.exact.setdefault(path.lower(), value)
+        self.compile(patterns)
+
+    def compile(self, patterns):
+        """
+        Combines each run of the compiled patterns into one, each pattern
+        as a group of its own, so a single match finds the first of the
+        run to match. Patterns with numbered references are left alone.
+        """
+        # (pattern, groups, value) triplets tried in turn; groups maps the
+        # number of each pattern's group to its value for combined patterns.
+        self.patterns = []
+        run = []
+        for pattern, value in patterns:
+            if has_numbered_references(pattern.pattern):
+                self.combine(run)
+                run = []
+                self.patterns.append((pattern, None, value))
+            else:
+                run.append((pattern, value))
+        self.combine(run)
+
+    def combine(self, run):
+        if not run:
+            return
+        if len(run) == 1:
+            self.patterns.append((run[0][0], None, run[0][1]))
+            return
+        alternatives = []
+        groups = {}
+        group = 1
+        for pattern, value in run:
+            alternatives.append(u"(%s)" % pattern.pattern)
+            groups[group] = value
+            group += pattern.groups + 1
+        try:
+            combined = re.compile(u"|".join(alternatives), re.IGNORECASE|re.UNICODE)
+        except re.error:
+            # e.g. two of the patterns share a group name; they are
+            # left to be tried one at a time.
+            self.patterns.extend([(pattern, None, value) for pattern, value in run])
+        else:
+            self.patterns.append((combined, groups, None))
+
+    def lookup(self, path):
+        """
+        Returns the value of the rule the path matches, else None.
+        """
+        match = self.exact.get(path.lower())
+        if match is not None:
+            return match
+        for pattern, groups, value in self.patterns:
+            found = pattern.match(path)
+            if found is not None:
+                if groups is None:
+                    return value
+                # The pattern's own group closes last of its groups.
+                return groups[found.lastindex]
+        return self.prefixes.lookup(path)